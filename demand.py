@@ -0,0 +1,76 @@
+import math
+import random
+
+'''
+Define constants
+'''
+MAX_POISSON_MEAN = 30   # Larger means are drawn as sums of Poisson numbers with smaller means (see poisson)
+
+'''
+Return a random number of arrivals drawn from a Poisson distribution with the given mean
+'''
+def poisson(mean):
+    count = 0
+    while mean > 0:
+        part = min(mean, MAX_POISSON_MEAN)    # exp(-part) must not underflow
+        limit = math.exp(-part)
+        product = random.random()
+        while product > limit:
+            count += 1
+            product *= random.random()
+        mean -= part
+    return count
+
+'''
+Return the rate in effect at the given time
+    rate: cars per second, or a schedule, i.e., a list of (seconds, cars per second) sorted by seconds,
+                        where each rate is in effect from its time until the next one (no car arrives before the first)
+'''
+def rate_at(rate, seconds):
+    if not isinstance(rate, list):
+        return rate
+    current = 0
+    for begin, value in rate:
+        if begin > seconds:
+            break
+        current = value
+    return current
+
+'''
+Define a Demand object, which spawns cars on lanes for new cars (see traffic.find_lanes_for_new_cars)
+    Cars arrive at each lane at its own rate as a Poisson process, and
+                        all arrivals due in a period are spawned in one pass over the lanes
+    A lane takes at most one car per period, when its entrance is clear (see traffic.Lane.add_newCar),
+                        so other arrivals wait as pending cars of the lane until later periods
+    period: ms between passes (e.g., simulation.TIME_DEMAND)
+'''
+class Demand():
+    def __init__(self, roads, rate, period):
+        if period <= 0:
+            raise ValueError("Period of a demand must be positive: " + str(period))
+        self.period = period
+        self.lanes = [lane for road in roads for lane in road.lanes_for_new_cars]
+        self.rates = [rate] * len(self.lanes)   # Rate or schedule of each lane (see rate_at)
+        self.pending = [0] * len(self.lanes)    # Cars that have arrived but not entered each lane
+        self.num_arrived = 0
+        self.num_spawned = 0
+
+    def set_rate(self, lane, rate):     # Change the rate or schedule of a lane
+        self.rates[self.lanes.index(lane)] = rate
+
+    '''
+    Draw arrivals of the period that ends at now (in ms) and spawn as many pending cars as lanes take
+    '''
+    def spawn(self, now):
+        seconds = now / 1000
+        for idx, lane in enumerate(self.lanes):
+            arrivals = poisson(rate_at(self.rates[idx], seconds) * self.period / 1000)
+            self.num_arrived += arrivals
+            self.pending[idx] += arrivals
+            if self.pending[idx] > 0 and lane.add_newCar():
+                self.pending[idx] -= 1
+                self.num_spawned += 1
+
+    def summary(self):
+        return "Demand: " + str(self.num_arrived) + " cars arrived, " + str(self.num_spawned) + " spawned, " +\
+               str(sum(self.pending)) + " pending"
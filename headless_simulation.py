@@ -0,0 +1,63 @@
+import time
+import random
+import argparse
+import simulation       # simulation.py needs to be in the same directory
+import scheduler        # scheduler.py needs to be in the same directory
+import traffic            # traffic.py needs to be in the same directory
+import recorder         # recorder.py needs to be in the same directory
+try:
+    import pygame       # Optional, used only to record frames
+except ImportError:
+    pygame = None
+
+'''
+Run the simulation without pygame (no display, surfaces, or fonts) for a given period of simulated time
+    Events fire in virtual time as fast as the CPU allows, e.g., python headless_simulation.py --seconds 3600 --seed 1
+    If record is a directory, frames are painted offscreen with pygame (still without a display)
+                        and written there at fps frames per simulated second (see recorder.Recorder for drop_frames)
+'''
+def run(seconds, seed=None, record=None, fps=30, image_format=recorder.FORMAT_PNG, drop_frames=recorder.RECORDER_DROP_FRAMES):
+    random.seed(seed)
+    clock = scheduler.Scheduler()
+    if record == None:
+        sim = simulation.Simulation(get_ticks=clock.get_ticks)
+        simulation.add_timers(sim, clock)
+        clock.run_until(seconds*1000)
+        return sim, clock
+
+    if pygame == None:
+        raise ValueError('Recording frames requires pygame')
+    pygame.font.init()
+    sim = simulation.Simulation(pygame, pygame.font.SysFont(None, traffic.LANE_WIDTH), clock.get_ticks)
+    simulation.add_timers(sim, clock)
+    frames = recorder.Recorder(pygame, sim, record, image_format, drop_frames)
+    clock.every(1000/fps, frames.capture)   # After other events due at the same time
+    frames.capture()    # Frame at time 0
+    clock.run_until(seconds*1000)
+    frames.close()
+    print(frames.summary())
+    return sim, clock
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the clustering simulation without a display')
+    parser.add_argument('--seconds', type=int, default=60, help='simulated time in seconds')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random number generator')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='cars per second arriving at each lane for new cars (see simulation.USE_DEMAND)')
+    parser.add_argument('--record', default=None, help='directory to write frames into (requires pygame)')
+    parser.add_argument('--fps', type=int, default=30, help='frames per simulated second to record')
+    parser.add_argument('--raw', action='store_true', help='record raw RGBA frames instead of PNG files')
+    parser.add_argument('--drop', action='store_true',
+                        help='drop frames while threads writing frames are behind instead of waiting (a faster run, but gaps)')
+    args = parser.parse_args()
+    if args.rate != None:
+        simulation.USE_DEMAND = True
+        simulation.DEMAND_RATE = args.rate
+
+    begin = time.time()
+    sim, clock = run(args.seconds, args.seed, args.record, args.fps, recorder.FORMAT_RAW if args.raw else recorder.FORMAT_PNG,
+                     args.drop)
+    num_cars = sum(len(lane.cars) for road in sim.roads for lane in road.lanes)
+    print(str(args.seconds) + " secs simulated in " + str(round(time.time() - begin, 2)) + " secs: " +\
+          str(num_cars) + " cars, " + str(len(sim.batch.cluster_list)) + " clusters in batch #" + str(sim.batch.batch_num) +\
+          ", " + str(clock.num_fired) + " events")
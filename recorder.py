@@ -0,0 +1,143 @@
+import os
+import queue
+import struct
+import threading
+import zlib
+import traffic            # traffic.py needs to be in the same directory
+
+'''
+Define constants
+'''
+FORMAT_PNG = 1          # frame_000000.png, ...
+FORMAT_RAW = 2          # frame_000000.rgba, ..., each with width x height pixels of 4 bytes (e.g., ffmpeg -f rawvideo -pix_fmt rgba)
+PNG_COMPRESSION = 6     # zlib level of PNG files
+RECORDER_THREADS = 2    # Threads that encode and write frames
+RECORDER_QUEUE = 64     # Frames waiting for the threads at most
+RECORDER_DROP_FRAMES = False   # If the queue is full, drop a new frame (True), or wait for a thread to take one (False)
+RECORDER_POLL = 0.1     # Seconds between checks that threads are alive while waiting for the queue
+
+'''
+Return PNG data of an image with 4 bytes (RGBA) per pixel
+    zlib releases the GIL while compressing, unlike pygame.image.save, so the simulation keeps running meanwhile
+'''
+def encode_png(data, width, height):
+    stride = width * 4
+    scanlines = b''.join(b'\x00' + data[idx:idx+stride] for idx in range(0, len(data), stride))     # Filter type 0 (none)
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +\
+           chunk(b'IDAT', zlib.compress(scanlines, PNG_COMPRESSION)) + chunk(b'IEND', b'')
+
+'''
+Define a Recorder object, which paints frames of a simulation on an offscreen surface (no display is needed)
+                        and writes them as files in a directory
+    Register capture with the scheduler of the simulation, e.g., clock.every(1000/fps, recorder.capture),
+                        so frames are taken at a fixed rate in simulated time, regardless of the speed of the run
+    Frames are numbered in the order of capture, and threads encode and write them,
+                        so the simulation never waits for files
+    If RECORDER_QUEUE frames are waiting, drop_frames decides between the two ways to keep up:
+        True drops a new frame, which leaves a gap in the numbers of files, e.g., while the traffic runs in real time
+        False waits until a thread has taken a frame off the queue (never until it is written), so no frame is missing
+                        (the default, as runs in virtual time only slow down, not the traffic)
+    Frames that cannot be written are counted and skipped, and if the threads have stopped,
+                        new frames are dropped instead of waiting for them
+'''
+class Recorder():
+    def __init__(self, pygame, sim, directory, image_format=FORMAT_PNG, drop_frames=RECORDER_DROP_FRAMES):
+        if image_format != FORMAT_PNG and image_format != FORMAT_RAW:
+            raise ValueError('Illegal image format is used')
+        os.makedirs(directory, exist_ok=True)
+        self.pygame = pygame
+        self.sim = sim
+        self.directory = directory
+        self.image_format = image_format
+        self.drop_frames = drop_frames
+        self.surface = pygame.Surface((traffic.SCREEN_WIDTH, traffic.SCREEN_HEIGHT))
+        self.frames = queue.Queue(RECORDER_QUEUE)    # (frame number, RGBX bytes), or None to stop a thread
+        self.num_captured = 0
+        self.num_dropped = 0
+        self.num_written = 0
+        self.num_failed = 0             # Frames that could not be encoded or written
+        self.lock = threading.Lock()    # Guards num_written and num_failed
+        self.stopped = False            # The threads were found stopped (see capture)
+        self.threads = [threading.Thread(target=self.write_frames, daemon=True) for idx in range(RECORDER_THREADS)]
+        for thread in self.threads:
+            thread.start()
+
+    def capture(self):  # Paint the current frame and queue it for the threads
+        self.sim.paint_dirty_on(self.surface)   # The surface keeps the previous frame, so only changes are painted
+        data = self.pygame.image.tobytes(self.surface, 'RGBX')  # Several times faster than 'RGB'; threads fill X in
+        frame = (self.num_captured, data)
+        self.num_captured += 1
+        if not self.stopped and not self.threads_alive():
+            print("Recorder: threads have stopped, so frames are dropped from now on")
+            self.stopped = True
+        if self.stopped:
+            self.num_dropped += 1
+        elif self.drop_frames:
+            try:
+                self.frames.put_nowait(frame)
+            except queue.Full:
+                self.num_dropped += 1
+        elif not self.put(frame):
+            self.num_dropped += 1
+
+    def threads_alive(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    '''
+    Put an item on the queue, waiting for a free slot only while any thread is alive to take items
+        Return False if the threads have stopped
+    '''
+    def put(self, item):
+        while self.threads_alive():
+            try:
+                self.frames.put(item, timeout=RECORDER_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write_frames(self):     # Run by each thread
+        width, height = self.surface.get_size()
+        opaque = b'\xff' * (width * height)
+        while True:
+            frame = self.frames.get()
+            if frame == None:
+                return
+            number, data = frame
+            try:
+                self.write_frame(number, data, width, height, opaque)
+            except Exception as error:  # E.g., a full disk, which must not stop the thread with frames left in the queue
+                with self.lock:
+                    self.num_failed += 1
+                    if self.num_failed == 1:
+                        print("Recorder: frame " + str(number) + " could not be written (" + str(error) + ")")
+                continue
+            with self.lock:
+                self.num_written += 1
+
+    def write_frame(self, number, data, width, height, opaque):
+        data = bytearray(data)
+        data[3::4] = opaque     # X bytes are undefined (see pygame.image.tobytes), so make pixels opaque
+        if self.image_format == FORMAT_PNG:
+            data = encode_png(data, width, height)
+            path = os.path.join(self.directory, 'frame_' + str(number).zfill(6) + '.png')
+        else:
+            path = os.path.join(self.directory, 'frame_' + str(number).zfill(6) + '.rgba')
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    def close(self):    # Wait until all queued frames are written, unless the threads have stopped
+        for thread in self.threads:
+            if not self.put(None):
+                break
+        for thread in self.threads:
+            thread.join()
+
+    def summary(self):
+        summary = "Recorder: " + str(self.num_captured) + " frames captured, " + str(self.num_written) + " written, " +\
+                  str(self.num_dropped) + " dropped, " + str(self.num_failed) + " failed"
+        if self.stopped:
+            summary += " (threads stopped)"
+        return summary
@@ -1,7 +1,12 @@
-import time
 import math
-import pygame
 import random
+import itertools
+import collections
+from array import array
+try:
+    import numpy    # Optional, used by the batched distance engine
+except ImportError:
+    numpy = None
 
 '''
 Define constants
@@ -15,19 +20,81 @@ CLUSTER_WIDTH = 2                       # Line thickness
 CLUSTER_MOVING_AVERAGE_WEIGHT = 0.1
 BATCH_FONT_SIZE = 30
 BATCH_NAME_COLOR = (255, 255, 255) # white
+FONT_CACHE_SIZE = 128                   # Fonts kept by size (see find_font), enough for every size that clusters use
+TEXT_CACHE_SIZE = 256                   # Rendered texts kept by (string, size, color) (see render_text)
+USE_CLUSTER_GRID = True                 # Find candidate clusters with a spatial grid instead of scanning all clusters
+CLUSTER_GRID_CELL = CLUSTER_BOUNDARY * 2    # Width and height of a grid cell in pixels
+CLUSTER_GRID_MAX_CELLS = 64             # Clusters that would span more cells are candidates everywhere instead (see ClusterGrid)
+RADIUS_EXACT = 1                        # Recompute the radius from all reports upon every insertion
+RADIUS_INCREMENTAL = 2                  # Maintain bounds of the radius, which is recomputed only if they cannot decide (see Cluster.includes)
+CLUSTER_RADIUS_MODE = RADIUS_EXACT
+CLUSTER_RADIUS_SLACK = 10               # Recompute the radius of a cluster losing reports once its bounds are farther apart than this
+CLUSTER_RADIUS_CHECK = False            # Compare the incremental radius with the exact radius (slow)
+CLUSTER_KEEP_REPORTS = True             # Keep the list of reports in each cluster (required for exact radii)
+USE_NUMPY_ENGINE = False                # Assign queued reports with a NumPy distance matrix (requires numpy)
+NUMPY_ENGINE_ROWS = 256                 # Queued reports in each distance matrix, whose size is this x # of nearby clusters
+NUMPY_ENGINE_COLUMNS = 16               # Columns for new clusters in a distance matrix before it grows (at least 1)
+STORAGE_OBJECTS = 1                     # Clusters keep lists of Report objects
+STORAGE_COLUMNAR = 2                    # Clusters keep indices into the ReportStore of their batch
+REPORT_STORAGE = STORAGE_COLUMNAR
+COALESCE_NONE = 0                       # Send every STOP report
+COALESCE_MIN_INTERVAL = 1               # Send at most one STOP report per car every COALESCE_INTERVAL ms
+COALESCE_STATE_CHANGE = 2               # Send a STOP report only when a car begins to stop
+COALESCE_HEARTBEAT = 3                  # Send a STOP report when a car begins to stop, then every COALESCE_INTERVAL ms with the count of reports it replaces
+COALESCE_POLICY = COALESCE_NONE
+COALESCE_INTERVAL = 1000
+COALESCE_GAP = 200                      # A car that has not reported for this many ms is considered to have moved in between
+COALESCE_SHADOW = False                 # Cluster all reports in a shadow batch as well, to measure changes in clusters
+
+fonts = collections.OrderedDict()   # size -> pygame.font.Font, from the least to the most recently used
+texts = collections.OrderedDict()   # (string, size, color) -> Surface, from the least to the most recently used
+
+'''
+Return a font of the given size, which is created only if it is not among the FONT_CACHE_SIZE most recently used
+'''
+def find_font(pygame, size):
+    font = fonts.get(size)
+    if font == None:
+        font = pygame.font.SysFont(None, size)
+        fonts[size] = font
+        if len(fonts) > FONT_CACHE_SIZE:
+            fonts.popitem(last=False)
+    else:
+        fonts.move_to_end(size)
+    return font
+
+'''
+Return a surface with the given text, which is rendered only if it is not among the TEXT_CACHE_SIZE most recently used
+'''
+def render_text(pygame, string, size, color):
+    key = (string, size, color)
+    text = texts.get(key)
+    if text == None:
+        text = find_font(pygame, size).render(string, True, color)
+        texts[key] = text
+        if len(texts) > TEXT_CACHE_SIZE:
+            texts.popitem(last=False)
+    else:
+        texts.move_to_end(key)
+    return text
 
 '''
 Define distance functions
 '''
 def distance(x1, y1, lane1, time1, event1,\
                          x2, y2, lane2, time2, event2):
-    if not lane1.road.on_the_same_road_with(lane2.road):
+    if not on_the_same_road(lane1.road, lane2.road):
         return math.inf     # For two reports to be close, their roads must be the same
     
     return math.sqrt(distance_position(x1, y1, x2, y2)**2 +\
                             distance_time(time1, time2)**2 +\
                             distance_event(event1, event2)**2)
 
+def on_the_same_road(road1, road2):
+    if road1.compatible_roads != None:      # Precomputed by traffic.add_intersections
+        return road1.compatible_roads[road2.road_id]
+    return road1.on_the_same_road_with(road2)
+
 def distance_position(x1, y1, x2, y2):
     return math.sqrt((x1-x2)**2 + (y1-y2)**2)    
 
@@ -37,32 +104,109 @@ def distance_time(time1, time2):
 def distance_event(event1, event2):
     return math.sqrt((event1-event2)**2)
 
+def distance_centroids(x1, y1, time1, event1, x2, y2, time2, event2):    # Distance regardless of roads
+    return math.sqrt(distance_position(x1, y1, x2, y2)**2 +\
+                            distance_time(time1, time2)**2 +\
+                            distance_event(event1, event2)**2)
+
 '''
 Define a Report object
 '''
 class Report():
-    def __init__(self, reporter, x, y, lane, event):
+    __slots__ = ('reporter', 'x', 'y', 'lane', 'time', 'event', 'index', 'count')
+    
+    def __init__(self, reporter, x, y, lane, event, time):
         self.reporter = reporter
         self.x = x
         self.y = y
         self.lane = lane        
-        self.time = int(time.time()) # current time in seconds        
+        self.time = time        # simulated time in seconds (with ms resolution) when the report was sent
         self.event = event        
+        self.index = None       # Sequence number in a batch (index in the ReportStore of the batch, if any)
+        self.count = 1          # Number of reports that this report stands for (see ReportCoalescer)
+
+'''
+Define a columnar store of reports, which keeps plain numbers instead of cars and lanes
+'''
+class ReportStore():
+    def __init__(self):
+        self.x = array('d')
+        self.y = array('d')
+        self.time = array('d')
+        self.event = array('d')
+        self.reporter_id = array('l')
+        self.lane_id = array('l')
+        self.road_id = array('l')       # -1 if roads have no ids
+        self.lanes = {}                 # lane_id -> lane, shared by all reports on the lane
+        self.base = 0                   # Index of the first report kept in the arrays (see discard_before)
+
+    def __len__(self):
+        return self.base + len(self.x)
+
+    def append(self, report):
+        self.x.append(report.x)
+        self.y.append(report.y)
+        self.time.append(report.time)
+        self.event.append(report.event)
+        self.reporter_id.append(report.reporter.car_id)
+        self.lane_id.append(report.lane.lane_id)
+        self.road_id.append(report.lane.road.road_id if report.lane.road.road_id != None else -1)
+        self.lanes[report.lane.lane_id] = report.lane
+        return len(self) - 1
+
+    def distance(self, cluster, idx):   # Same as cluster.distance(report) for the report at idx
+        idx -= self.base
+        return distance(cluster.x, cluster.y, cluster.lane, cluster.time, cluster.event,\
+                        self.x[idx], self.y[idx], self.lanes[self.lane_id[idx]], self.time[idx], self.event[idx])
+
+    '''
+    Free reports with indices smaller than index, which are no longer used (see Batch.evict)
+        Arrays are trimmed once at least half of them can be freed, so that trimming costs O(1) amortized
+    '''
+    def discard_before(self, index):
+        num_discarded = index - self.base
+        if num_discarded * 2 < len(self.x):
+            return
+        for column in (self.x, self.y, self.time, self.event, self.reporter_id, self.lane_id, self.road_id):
+            del column[:num_discarded]
+        self.base = index
         
 '''
 Define a Cluster object
 '''
+cluster_ids = itertools.count()     # Clusters created earlier get smaller ids, which preserves the order of Batch.cluster_list
+
 class Cluster():
-    def __init__(self, pygame, report):
+    def __init__(self, pygame, report, store=None):
         self.pygame = pygame
+        self.store = store          # If given, reports are kept as indices into the store
+        self.id = next(cluster_ids)
+        self.grid_cells = None      # Cells of ClusterGrid that this cluster is registered in
+        self.merged_into = None     # Cluster that this cluster has been combined into
+        self.first_live = 0         # Reports with smaller sequence numbers have been evicted (see Batch.evict)
+        self.num_evicted = 0        # Number of evicted reports still in self.reports
         self.x = report.x
         self.y = report.y
         self.lane = report.lane
         self.time = report.time
         self.event = report.event
-        self.reports = [report]
+        if store != None:
+            self.reports = array('l', [report.index] if CLUSTER_KEEP_REPORTS else [])
+        else:
+            self.reports = [report] if CLUSTER_KEEP_REPORTS else []
+        self.report_parts = []      # Reports of clusters combined into this one, not yet appended to self.reports
+        self.report_roads = {report.lane.road}  # Roads of reports, evicted or not (see combine_with)
+        
+        # Sufficient statistics of reports, as offsets from the first report to keep sums of squares small
+        self.origin = (report.x, report.y, report.time, report.event)
+        self.count = report.count
+        self.sums = [0, 0, 0, 0]            # Sums of x, y, time, and event offsets
+        self.sum_squares = 0                # Sum of squared distances between reports and origin
+        self.sum_squares_abs = 0            # Sum of absolute values added to or subtracted from sum_squares (see rms_distance)
+        
         self.radius = CLUSTER_BOUNDARY
-        self.max_distance = 0
+        self.max_distance = 0               # Distance to the farthest report (an upper bound in RADIUS_INCREMENTAL mode)
+        self.max_distance_lower = 0         # Lower bound of the distance to the farthest report
         self.color = report.reporter.color
         #self.color = (CLUSTER_COLOR[0]+random.randrange(-CLUSTER_COLOR_VAR,CLUSTER_COLOR_VAR),
         #               CLUSTER_COLOR[1]+random.randrange(-CLUSTER_COLOR_VAR,CLUSTER_COLOR_VAR),
@@ -73,11 +217,14 @@ class Cluster():
                          report.x, report.y, report.lane, report.time, report.event)
 
     def insert(self, report):
-        if not self.lane.road.on_the_same_road_with(report.lane.road):    # For a report to belong to a cluster, their roads must be the same
+        if not on_the_same_road(self.lane.road, report.lane.road):    # For a report to belong to a cluster, their roads must be the same
             return
 
         # Insert the new report into the report list
-        self.reports.append(report)
+        if CLUSTER_KEEP_REPORTS:
+            self.reports.append(report.index if self.store != None else report)
+        self.add_to_sums(report)
+        self.report_roads.add(report.lane.road)
 
         '''
         Method #1: Centroid is a weighted moving average of reports
@@ -86,22 +233,28 @@ class Cluster():
                                                                                     vs. those that affect both directions
         '''
         # Update centroid as a weighted moving average of reports
-        self.x = self.x * (1 - CLUSTER_MOVING_AVERAGE_WEIGHT)\
-                         + report.x * CLUSTER_MOVING_AVERAGE_WEIGHT
-        self.y = self.y * (1 - CLUSTER_MOVING_AVERAGE_WEIGHT)\
-                         + report.y * CLUSTER_MOVING_AVERAGE_WEIGHT
-        self.time = self.time * (1 - CLUSTER_MOVING_AVERAGE_WEIGHT)\
-                         + report.time * CLUSTER_MOVING_AVERAGE_WEIGHT         
-        self.event = self.event * (1 - CLUSTER_MOVING_AVERAGE_WEIGHT)\
-                         + report.event * CLUSTER_MOVING_AVERAGE_WEIGHT
+        # (a report that stands for n reports moves the centroid as much as n identical reports)
+        if report.count == 1:
+            weight = CLUSTER_MOVING_AVERAGE_WEIGHT
+        else:
+            weight = 1 - (1 - CLUSTER_MOVING_AVERAGE_WEIGHT)**report.count
+        prev_x, prev_y, prev_time, prev_event = self.x, self.y, self.time, self.event
+        self.x = self.x * (1 - weight)\
+                         + report.x * weight
+        self.y = self.y * (1 - weight)\
+                         + report.y * weight
+        self.time = self.time * (1 - weight)\
+                         + report.time * weight         
+        self.event = self.event * (1 - weight)\
+                         + report.event * weight
 
         # Update radius        
-        max_distance = 0
-        for r in self.reports:
-            distance = self.distance(r)
-            if max_distance < distance:
-                max_distance = distance
-        self.radius = max_distance + CLUSTER_BOUNDARY
+        if CLUSTER_RADIUS_MODE == RADIUS_INCREMENTAL or not CLUSTER_KEEP_REPORTS:
+            shift = distance_centroids(prev_x, prev_y, prev_time, prev_event,\
+                                       self.x, self.y, self.time, self.event)
+            self.update_radius_bounds(shift, self.distance(report))
+        else:
+            self.update_radius()
         
         '''
         Method #2: X/Y of centroid remains at the position of the initial report
@@ -138,87 +291,586 @@ class Cluster():
         self.radius = max_distance + CLUSTER_BOUNDARY
         '''
         
-    def include_report(self, report):
+    def report_distances(self):
+        self.compact_reports()
+        if self.store != None:
+            for idx in self.reports:
+                if idx >= self.first_live:
+                    yield self.store.distance(self, idx)
+        else:
+            for r in self.reports:
+                if r.index >= self.first_live:
+                    yield self.distance(r)
+
+    '''
+    Set the radius from the distance to the farthest report
+    '''
+    def update_radius(self):
+        max_distance = 0
+        for distance in self.report_distances():
+            if max_distance < distance:
+                max_distance = distance
+        self.max_distance = max_distance
+        self.max_distance_lower = max_distance
+        self.radius = max_distance + CLUSTER_BOUNDARY
+
+    '''
+    Update the radius after the centroid has moved by shift and a report at distance_new has been added
+        Every old report is now within max_distance + shift (triangle inequality),
+                        and the farthest old report is at least max_distance_lower - shift away.
+        The radius uses the upper bound, so it never misses a report,
+                        and includes recomputes it only when a decision falls between the two bounds
+    '''
+    def update_radius_bounds(self, shift, distance_new):
+        self.set_radius_bounds(max(self.max_distance + shift, distance_new),\
+                               max(self.max_distance_lower - shift, distance_new))
+
+    def set_radius_bounds(self, upper, lower):   # Bounds are widened slightly to absorb rounding errors of distance functions
+        self.max_distance = upper * (1 + 1e-9) + 1e-9
+        self.max_distance_lower = max(0, lower * (1 - 1e-9) - 1e-9)
+        self.radius = self.max_distance + CLUSTER_BOUNDARY
+
+        if CLUSTER_RADIUS_CHECK and CLUSTER_KEEP_REPORTS:
+            self.check_radius()
+
+    def check_radius(self):
+        max_distance = 0
+        for distance in self.report_distances():
+            max_distance = max(max_distance, distance)
+        tolerance = 1e-6 * max(1, max_distance) if math.isfinite(max_distance) else 0
+        if not (self.max_distance_lower - tolerance <= max_distance <= self.max_distance + tolerance):
+            raise ValueError('Radius bounds [' + str(self.max_distance_lower) + ', ' + str(self.max_distance) +\
+                             '] do not contain the exact distance ' + str(max_distance))
+        
+    '''
+    Return whether a report or centroid at distance from the centroid is within the radius
+        The bounds of the distance to the farthest report decide, unless distance falls between them,
+                        in which case the radius is recomputed, so that decisions are the same as with exact radii
+        Without report lists, the upper bound decides
+    '''
+    def includes(self, distance):
+        if distance <= self.max_distance_lower + CLUSTER_BOUNDARY:
+            return True
+        if distance <= self.radius and self.max_distance_lower < self.max_distance and CLUSTER_KEEP_REPORTS:
+            self.update_radius()
+        return distance <= self.radius
+
+    def include_report(self, report):   # A report on a road not on the same road with this cluster's is never taken
         distance_to_report = self.distance(report)
-        return (distance_to_report <= self.radius, distance_to_report)
+        return (distance_to_report < math.inf and self.includes(distance_to_report), distance_to_report)
 
     def include_cluster(self, cluster):
         distance_to_cluster = distance(self.x, self.y, self.lane, self.time, self.event,\
                          cluster.x, cluster.y, cluster.lane, cluster.time, cluster.event)
-        return distance_to_cluster <= self.radius
+        return self.includes(distance_to_cluster)
+
+    def add_to_sums(self, report):
+        offset = (report.x - self.origin[0], report.y - self.origin[1],\
+                  report.time - self.origin[2], report.event - self.origin[3])
+        self.count += report.count
+        for idx in range(4):
+            self.sums[idx] += offset[idx] * report.count
+        squares = (offset[0]**2 + offset[1]**2 + offset[2]**2 + offset[3]**2) * report.count
+        self.sum_squares += squares
+        self.sum_squares_abs += squares
+
+    '''
+    Merge the sufficient statistics of another cluster, after moving them to this cluster's origin
+        For offsets o from the other origin and d = (other origin - this origin),
+                        sum(o+d) = sum(o) + n*d and sum(|o+d|^2) = sum(|o|^2) + 2*d.sum(o) + n*|d|^2
+    '''
+    def add_cluster_to_sums(self, cluster):
+        d = [cluster.origin[idx] - self.origin[idx] for idx in range(4)]
+        cross = 2 * sum(d[idx] * cluster.sums[idx] for idx in range(4))
+        squares = cluster.count * sum(d[idx]**2 for idx in range(4))
+        self.sum_squares += cluster.sum_squares + cross + squares
+        self.sum_squares_abs += cluster.sum_squares_abs + abs(cross) + squares
+        for idx in range(4):
+            self.sums[idx] += cluster.sums[idx] + cluster.count * d[idx]
+        self.count += cluster.count
+
+    '''
+    Root mean square distance between reports and the mean of reports,
+                        which is a lower bound of the distance to the farthest report
+        sum_squares / count - mean^2 cancels out most digits once the reports are far from the origin,
+                        and every report added and evicted leaves rounding errors in the sums,
+                        so the variance is lowered by an error term that grows with sum_squares_abs
+    '''
+    def rms_distance(self):
+        mean = [self.sums[idx] / self.count for idx in range(4)]
+        variance = self.sum_squares / self.count - sum(m**2 for m in mean)
+        error = 1e-9 * self.sum_squares_abs / self.count
+        return math.sqrt(max(0, variance - error))
+
+    '''
+    Remove an evicted report with sequence number index from the sums
+        The report remains in self.reports until the list is compacted, but it is skipped from then on
+    '''
+    def evict(self, index, x, y, time, event, count):
+        offset = (x - self.origin[0], y - self.origin[1], time - self.origin[2], event - self.origin[3])
+        self.count -= count
+        for idx in range(4):
+            self.sums[idx] -= offset[idx] * count
+        squares = (offset[0]**2 + offset[1]**2 + offset[2]**2 + offset[3]**2) * count
+        self.sum_squares -= squares
+        self.sum_squares_abs += squares
+        self.first_live = index + 1     # Reports are evicted in the order of their sequence numbers
+        if CLUSTER_KEEP_REPORTS:
+            self.num_evicted += 1
+
+    '''
+    Move the centroid to the mean of the remaining reports and update the radius after evictions
+        Remaining reports are within max_distance + shift of the new centroid,
+                        but the farthest report might have been evicted, so the lower bound falls back to RMS distance.
+        The radius is recomputed exactly once the bounds are more than CLUSTER_RADIUS_SLACK apart,
+                        so that the radius of a cluster that is only losing reports does not keep growing
+    '''
+    def update_after_eviction(self):
+        if CLUSTER_KEEP_REPORTS and self.num_evicted * 2 > len(self.reports) + sum(len(part) for part in self.report_parts):
+            self.compact_reports()
+            if self.store != None:
+                self.reports = array('l', [idx for idx in self.reports if idx >= self.first_live])
+            else:
+                self.reports = [r for r in self.reports if r.index >= self.first_live]
+            self.num_evicted = 0
+
+        prev_x, prev_y, prev_time, prev_event = self.x, self.y, self.time, self.event
+        self.x = self.origin[0] + self.sums[0] / self.count
+        self.y = self.origin[1] + self.sums[1] / self.count
+        self.time = self.origin[2] + self.sums[2] / self.count
+        self.event = self.origin[3] + self.sums[3] / self.count
+
+        if CLUSTER_RADIUS_MODE == RADIUS_EXACT and CLUSTER_KEEP_REPORTS:
+            self.update_radius()
+        else:
+            shift = distance_centroids(prev_x, prev_y, prev_time, prev_event,\
+                                       self.x, self.y, self.time, self.event)
+            upper = self.max_distance + shift
+            lower = min(self.rms_distance(), upper)
+            if upper - lower > CLUSTER_RADIUS_SLACK and CLUSTER_KEEP_REPORTS:
+                self.update_radius()
+            else:
+                self.set_radius_bounds(upper, lower)
+
+    '''
+    Append the reports of combined clusters to self.reports, which is deferred until reports are scanned,
+                        so that combining clusters does not copy their reports
+    '''
+    def compact_reports(self):
+        for part in self.report_parts:
+            self.reports.extend(part)
+        self.report_parts = []
 
     def combine_with(self, cluster):
-        # Extend report list
-        self.reports.extend(cluster.reports)
+        # Keep the report list of the other cluster (see compact_reports)
+        if CLUSTER_KEEP_REPORTS:
+            self.report_parts.append(cluster.reports)
+            self.report_parts.extend(cluster.report_parts)
+            self.num_evicted += cluster.num_evicted
+        self.first_live = max(self.first_live, cluster.first_live)
+        self.add_cluster_to_sums(cluster)
 
         # Update x, y, time, and event as the average of all reports
-        self.x = 0
-        self.y = 0
-        self.time = 0
-        self.event = 0
-        for report in self.reports:
-            self.x += report.x
-            self.y += report.y
-            self.time += report.time
-            self.event += report.event
-        self.x = self.x / len(self.reports)
-        self.y = self.y / len(self.reports)
-        self.time = self.time / len(self.reports)
-        self.event = self.event / len(self.reports)        
+        prev_x, prev_y, prev_time, prev_event = self.x, self.y, self.time, self.event
+        self.x = self.origin[0] + self.sums[0] / self.count
+        self.y = self.origin[1] + self.sums[1] / self.count
+        self.time = self.origin[2] + self.sums[2] / self.count
+        self.event = self.origin[3] + self.sums[3] / self.count
         
-        # Update radius
-        max_distance = 0
-        for report in self.reports:
-            distance = self.distance(report)
-            if max_distance < distance:
-                max_distance = distance
-        self.radius = max_distance + CLUSTER_BOUNDARY
+        # Update radius, which is recomputed from all reports in RADIUS_EXACT mode, as upon insertions
+        # Otherwise, bounds follow from those of each cluster, whose reports were within them before the centroids moved
+        # Reports on roads not on the same road with this cluster's are infinitely far away (see distance),
+        #       and bounds of either cluster tell nothing about positions if they are infinite
+        self.report_roads |= cluster.report_roads
+        if CLUSTER_RADIUS_MODE == RADIUS_EXACT and CLUSTER_KEEP_REPORTS:
+            self.update_radius()
+        else:
+            self.combine_radius_bounds(cluster, prev_x, prev_y, prev_time, prev_event)
 
         # Update color with the average color of two clusters
         self.color = (int((self.color[0]+cluster.color[0])/2), int((self.color[1]+cluster.color[1])/2), int((self.color[2]+cluster.color[2])/2))
+
+    def combine_radius_bounds(self, cluster, prev_x, prev_y, prev_time, prev_event):    # prev_*: centroid before combining
+        shift = distance_centroids(prev_x, prev_y, prev_time, prev_event,\
+                                   self.x, self.y, self.time, self.event)
+        shift_other = distance_centroids(cluster.x, cluster.y, cluster.time, cluster.event,\
+                                         self.x, self.y, self.time, self.event)
+        compatible = all(on_the_same_road(self.lane.road, road) for road in cluster.report_roads)
+        upper = max(self.max_distance + shift, cluster.max_distance + shift_other) if compatible else math.inf
+        lower = self.rms_distance()
+        if math.isfinite(self.max_distance):
+            lower = max(lower, self.max_distance_lower - shift)
+        if compatible and math.isfinite(cluster.max_distance):
+            lower = max(lower, cluster.max_distance_lower - shift_other)
+        self.set_radius_bounds(upper, lower)
         
-    def paint_on(self, screen):
-        if len(self.reports) <= 10: # Show only significant clusters and exclude those with temporary congestion
-            return
+    def is_painted(self):   # Show only significant clusters and exclude those with temporary congestion
+        return self.count > 10
+
+    def paint_on(self, screen):     # Return the areas painted on the screen
+        if not self.is_painted():
+            return []
 
         # Draw a circle that represents this cluster
-        self.pygame.draw.circle(screen, self.color, [self.x,self.y], self.radius, CLUSTER_WIDTH)
+        circle = self.pygame.draw.circle(screen, self.color, [self.x,self.y], self.radius, CLUSTER_WIDTH)
 
         # Show the number of reports that belong to this cluster
-        font_report_num = self.pygame.font.SysFont(None, min(len(self.reports)+20,100))        
-        report_num = font_report_num.render(str(len(self.reports)), True, self.color)
-        screen.blit(report_num, (self.x, self.y))       
+        report_num = render_text(self.pygame, str(self.count), min(self.count+20,100), self.color)
+        return [circle, screen.blit(report_num, (self.x, self.y))]
+
+
+'''
+Define a spatial grid of clusters
+    A cluster is registered in every cell that its circle (centroid and radius) overlaps.
+    Since a report's distance to a cluster is never smaller than their distance on the x/y plane,
+        a report can belong only to clusters registered in the cell that contains the report
+    Clusters with an infinite radius, or one that spans more than CLUSTER_GRID_MAX_CELLS cells
+        (e.g., an upper bound in RADIUS_INCREMENTAL mode), are kept aside and returned for every cell
+'''
+class ClusterGrid():
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}             # (column, row) -> set of clusters
+        self.clusters = set()       # All clusters in this grid
+        self.unbounded = set()      # Clusters with an infinite or large radius, which are candidates in any cell
+
+    def cell_of(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def cells_of(self, cluster):
+        if not math.isfinite(cluster.radius):
+            return None
+        reach = cluster.radius * (1 + 1e-9) + 1e-9  # Absorb rounding errors of distance functions
+        left, top = self.cell_of(cluster.x - reach, cluster.y - reach)
+        right, bottom = self.cell_of(cluster.x + reach, cluster.y + reach)
+        if (right - left + 1) * (bottom - top + 1) > CLUSTER_GRID_MAX_CELLS:
+            return None
+        return [(column, row) for column in range(left, right+1) for row in range(top, bottom+1)]
+
+    def add(self, cluster):
+        self.clusters.add(cluster)
+        cluster.grid_cells = self.cells_of(cluster)
+        if cluster.grid_cells == None:
+            self.unbounded.add(cluster)
+            return
+        for cell in cluster.grid_cells:
+            if cell in self.cells:
+                self.cells[cell].add(cluster)
+            else:
+                self.cells[cell] = {cluster}
+
+    def remove(self, cluster):
+        self.clusters.discard(cluster)
+        if cluster.grid_cells == None:
+            self.unbounded.discard(cluster)
+            return
+        for cell in cluster.grid_cells:
+            clusters = self.cells[cell]
+            clusters.discard(cluster)
+            if len(clusters) == 0:
+                del self.cells[cell]
+
+    def update(self, cluster):    # Call whenever the centroid or radius of a cluster changes
+        if self.cells_of(cluster) == cluster.grid_cells:
+            return
+        self.remove(cluster)
+        self.add(cluster)
+
+    def candidates(self, x, y):  # Return clusters that might include a report at (x, y)
+        clusters = self.cells.get(self.cell_of(x, y), ())
+        if len(self.unbounded) > 0:
+            clusters = self.unbounded.union(clusters)
+        return clusters
+
+
+'''
+Define a matrix of distances between reports (rows) and clusters (columns), which requires numpy
+    Distances are computed in the same order of operations as distance(),
+                        so that they are identical to those of the scalar functions
+    Columns are added as clusters are created, and the matrix doubles its columns when they run out
+'''
+class DistanceMatrix():
+    def __init__(self, reports, clusters):
+        self.x = numpy.array([report.x for report in reports], dtype=float)
+        self.y = numpy.array([report.y for report in reports], dtype=float)
+        self.time = numpy.array([report.time for report in reports], dtype=float)
+        self.event = numpy.array([report.event for report in reports], dtype=float)
+
+        # Index reports by their roads, to check road compatibility once per pair of roads
+        self.roads = []
+        road_index = {}
+        for report in reports:
+            if report.lane.road not in road_index:
+                road_index[report.lane.road] = len(self.roads)
+                self.roads.append(report.lane.road)
+        self.road_of_report = numpy.array([road_index[report.lane.road] for report in reports])
+        self.compatible = {}        # road of a cluster -> boolean array, one element per road of reports
+
+        self.max_clusters = len(clusters) + len(reports)    # Each report can create at most one cluster
+        capacity = min(len(clusters) + NUMPY_ENGINE_COLUMNS, self.max_clusters)   # Room for a few new clusters before growing
+        self.distances = numpy.full((len(reports), capacity), math.inf)
+        self.radii = numpy.full(capacity, math.inf)
+        self.lower_radii = numpy.full(capacity, math.inf)   # Radii from the lower bounds (see Cluster.includes)
+        self.clusters = list(clusters)
+        if len(clusters) > 0:
+            self.radii[:len(clusters)] = [cluster.radius for cluster in clusters]
+            self.lower_radii[:len(clusters)] = [cluster.max_distance_lower + CLUSTER_BOUNDARY for cluster in clusters]
+            self.find_distances(clusters, self.distances[:, :len(clusters)])
+
+    def add_cluster(self, cluster, first_row):
+        if len(self.clusters) == len(self.radii):
+            self.grow()
+        self.clusters.append(cluster)
+        self.update_cluster(len(self.clusters)-1, first_row)
+
+    def grow(self):
+        capacity = min(len(self.radii) * 2, self.max_clusters)
+        distances = numpy.full((len(self.distances), capacity), math.inf)
+        distances[:, :len(self.radii)] = self.distances
+        radii = numpy.full(capacity, math.inf)
+        radii[:len(self.radii)] = self.radii
+        lower_radii = numpy.full(capacity, math.inf)
+        lower_radii[:len(self.lower_radii)] = self.lower_radii
+        self.distances, self.radii, self.lower_radii = distances, radii, lower_radii
+
+    def find_compatible(self, road):    # Return whether each road of reports is on the same road with the given road
+        if road not in self.compatible:
+            self.compatible[road] = numpy.array([on_the_same_road(road, r) for r in self.roads], dtype=bool)
+        return self.compatible[road]
+
+    '''
+    Write distances from all reports (rows) to the given clusters (columns) into distances at once,
+                        with the same operations as update_cluster, but in place to save memory
+    '''
+    def find_distances(self, clusters, distances):
+        x = numpy.array([cluster.x for cluster in clusters], dtype=float)
+        y = numpy.array([cluster.y for cluster in clusters], dtype=float)
+        time = numpy.array([cluster.time for cluster in clusters], dtype=float)
+        event = numpy.array([cluster.event for cluster in clusters], dtype=float)
+        compatible = numpy.array([self.find_compatible(cluster.lane.road) for cluster in clusters])   # Clusters x roads
+
+        numpy.subtract(x, self.x[:, None], out=distances)
+        distances **= 2
+        distance = numpy.subtract(y, self.y[:, None])
+        distance **= 2
+        distances += distance
+        numpy.sqrt(distances, out=distances)    # distance_position
+        distances **= 2
+        for cluster_values, report_values in ((time, self.time), (event, self.event)):
+            numpy.subtract(cluster_values, report_values[:, None], out=distance)
+            distance **= 2
+            numpy.sqrt(distance, out=distance)  # distance_time and distance_event
+            distance **= 2
+            distances += distance
+        numpy.sqrt(distances, out=distances)
+        distances[~compatible[:, self.road_of_report].T] = math.inf
+
+    def update_cluster(self, column, first_row):    # Recompute a column from first_row onwards
+        cluster = self.clusters[column]
+        self.update_radii(column)
+        compatible = self.find_compatible(cluster.lane.road)[self.road_of_report[first_row:]]
+
+        distance_position = numpy.sqrt((cluster.x - self.x[first_row:])**2 + (cluster.y - self.y[first_row:])**2)
+        distance_time = numpy.sqrt((cluster.time - self.time[first_row:])**2)
+        distance_event = numpy.sqrt((cluster.event - self.event[first_row:])**2)
+        distances = numpy.sqrt(distance_position**2 + distance_time**2 + distance_event**2)
+        self.distances[first_row:, column] = numpy.where(compatible, distances, math.inf)
+
+    def update_radii(self, column):
+        cluster = self.clusters[column]
+        self.radii[column] = cluster.radius
+        self.lower_radii[column] = cluster.max_distance_lower + CLUSTER_BOUNDARY
+
+    '''
+    Return the column of the nearest cluster that includes the report in a row, or None if there is none
+        Like the scalar search, ties are broken in favor of the earliest cluster,
+                        and clusters whose bounds cannot decide are asked to recompute their radii
+    '''
+    def nearest(self, row):
+        num_clusters = len(self.clusters)
+        if num_clusters == 0:
+            return None
+        distances = self.distances[row, :num_clusters]
+        undecided = (distances > self.lower_radii[:num_clusters]) & (distances <= self.radii[:num_clusters]) &\
+                    (distances < math.inf)
+        for column in numpy.flatnonzero(undecided):
+            self.clusters[column].includes(float(distances[column]))
+            self.update_radii(column)
+        distances = numpy.where(distances <= self.radii[:num_clusters], distances, math.inf)
+        column = int(numpy.argmin(distances))
+        if distances[column] < math.inf:
+            return column
+        return None
+
+
+'''
+Define a policy that coalesces repeated STOP reports of each car before they reach a batch
+    A car stuck in a queue reports STOP on every move, which mostly repeats its previous report.
+    The coalescer outlives batches, so pass the same instance to every Batch
+'''
+class ReportCoalescer():
+    def __init__(self, policy=COALESCE_POLICY, interval=COALESCE_INTERVAL):
+        self.policy = policy
+        self.interval = interval
+        self.reporters = {}         # car_id -> [time of last report received, time of last report sent, # of reports suppressed since]
+        self.last_cleanup = 0
+
+        # Statistics
+        self.received = 0
+        self.sent = 0
+        self.significant = 0        # Sum of # of significant clusters over batches
+        self.significant_shadow = 0 # Same as above, but without coalescing (requires COALESCE_SHADOW)
+        self.offset_shadow = 0      # Sum of distances between each significant shadow cluster and its nearest significant cluster
+        self.num_compared = 0
+
+    '''
+    Return the number of reports that a report should stand for, or 0 if the report should be suppressed
+    '''
+    def admit(self, car, event, now):
+        self.received += 1
+        if event != EVENT_STOP or self.policy == COALESCE_NONE:
+            self.sent += 1
+            return 1
+
+        state = self.reporters.get(car.car_id)
+        stopped = (state != None) and (now - state[0] <= COALESCE_GAP)    # Stopped since the last report
+        count = 0
+        if not stopped:
+            count = 1
+        elif self.policy == COALESCE_MIN_INTERVAL:
+            count = 1 if now - state[1] >= self.interval else 0
+        elif self.policy == COALESCE_HEARTBEAT:
+            count = state[2] + 1 if now - state[1] >= self.interval else 0
+
+        if state == None:
+            state = self.reporters[car.car_id] = [now, now, 0]
+        state[0] = now
+        if count > 0:
+            state[1] = now
+            state[2] = 0
+            self.sent += 1
+        else:
+            state[2] += 1
+
+        if now - self.last_cleanup > self.interval * 10:    # Forget cars that stopped reporting, e.g., those that left the screen
+            self.reporters = {car_id: s for car_id, s in self.reporters.items() if now - s[0] <= max(COALESCE_GAP, self.interval)}
+            self.last_cleanup = now
+        return count
+
+    '''
+    Compare significant clusters (those painted on the screen) with and without coalescing
+    '''
+    def compare(self, cluster_list, shadow_cluster_list):
+        significant = [c for c in cluster_list if c.count > 10]
+        significant_shadow = [c for c in shadow_cluster_list if c.count > 10]
+        self.significant += len(significant)
+        self.significant_shadow += len(significant_shadow)
+        self.num_compared += 1
+        for c1 in significant_shadow:
+            self.offset_shadow += min([distance_position(c1.x, c1.y, c2.x, c2.y) for c2 in significant], default=0)
+
+    def summary(self):
+        summary = "coalescing saved " + str(self.received - self.sent) + " of " + str(self.received) + " reports"
+        if self.num_compared > 0:
+            summary += ", significant clusters " + str(self.significant) + " vs. " + str(self.significant_shadow) + " without coalescing"
+            if self.significant_shadow > 0:
+                summary += ", mean offset " + str(round(self.offset_shadow / self.significant_shadow, 1)) + " pixels"
+        return summary
 
 
 '''
 Define a batch object
 '''
 class Batch():
-    def __init__(self, pygame, batch_num, time_batch):
+    '''
+    window: if given, clusters persist and reports are evicted once they are older than window ms
+                        (otherwise, clusters last until the batch is replaced after time_batch ms)
+    get_ticks: function that returns the current time in ms (pygame.time.get_ticks by default)
+                        Reports are stamped with this clock, so clusters do not depend on the speed of a run
+                        pygame can be None for headless runs, which never paint, if get_ticks is given
+    '''
+    def __init__(self, pygame, batch_num, time_batch, coalescer=None, window=None, get_ticks=None):
         self.pygame = pygame
+        self.get_ticks = get_ticks if get_ticks != None else pygame.time.get_ticks
+        self.coalescer = coalescer
+        self.shadow = None      # Batch that receives all reports without coalescing
+        if coalescer != None and COALESCE_SHADOW:
+            self.shadow = Batch(pygame, batch_num, time_batch, None, window, get_ticks)
+        self.window = window
+        self.window_queue = collections.deque()     # (time received, report's sequence number, x, y, time, event, count, cluster)
+        self.report_ids = itertools.count()         # Sequence numbers of reports if there is no ReportStore
         self.report_queue = []
         self.cluster_list = []
+        self.shards = {}        # road_id -> ClusterGrid of clusters whose lanes are on the road
+        self.store = ReportStore() if REPORT_STORAGE == STORAGE_COLUMNAR else None
         self.batch_num = batch_num
-        self.font_batch_num = pygame.font.SysFont(None, BATCH_FONT_SIZE)        
-        self.begin_time = pygame.time.get_ticks()    # get time in milliseconds since pygame.init() was called
+        self.begin_time = self.get_ticks()    # get time in milliseconds since pygame.init() was called
         self.end_time = self.begin_time + time_batch
         self.time_batch = time_batch
         
+    def label(self):    # Text painted at the top left corner of the screen
+        if self.window != None:
+            return "sliding window of " + str(int(self.window/1000)) + " secs"
+        remaining_time = int((self.end_time - self.get_ticks())/1000) + 1        
+        return "batch #" + str(self.batch_num) + " (" + str(remaining_time) + "/" + str(int(self.time_batch/1000)) + " secs remain)"
+
     def paint_on(self, screen):
-        remaining_time = int((self.end_time - self.pygame.time.get_ticks())/1000) + 1        
-        batch_num_object = self.font_batch_num.render("batch #" + str(self.batch_num) + " (" + str(remaining_time) + "/" + str(int(self.time_batch/1000)) + " secs remain)", True, BATCH_NAME_COLOR)
-        screen.blit(batch_num_object, (0,0))
+        batch_num_object = render_text(self.pygame, self.label(), BATCH_FONT_SIZE, BATCH_NAME_COLOR)
+        rects = [screen.blit(batch_num_object, (0,0))]     # Areas painted on the screen
         for cluster in self.cluster_list:
-            cluster.paint_on(screen)
+            rects.extend(cluster.paint_on(screen))
+        return rects
 
     def report(self, car, event):
-        self.report_queue.append(Report(car, car.rect.centerx, car.rect.centery, car.lane, event))
+        if self.shadow != None:
+            self.shadow.report(car, event)
+
+        count = 1
+        if self.coalescer != None:
+            count = self.coalescer.admit(car, event, self.get_ticks())
+            if count == 0:
+                return
+        
+        report = Report(car, car.rect.centerx, car.rect.centery, car.lane, event, self.get_ticks() / 1000)
+        report.count = count
+        if self.store != None:
+            report.index = self.store.append(report)
+        else:
+            report.index = next(self.report_ids)
+        self.report_queue.append(report)
         
     def process_reports(self):    
+        if self.window != None:
+            self.evict(self.get_ticks() - self.window)
+        
+        if USE_NUMPY_ENGINE and numpy != None and len(self.report_queue) > 0:
+            self.assign_reports_numpy()
+        else:
+            self.assign_reports()
+        
+        self.report_queue.clear()
+
+        self.combine_clusters()
+
+        if self.shadow != None:
+            self.shadow.process_reports()
+            self.coalescer.compare(self.cluster_list, self.shadow.cluster_list)
+        
+        # print clusters
+        #for idx, cluster in enumerate(self.cluster_list):
+        #    print(idx, len(cluster.reports), cluster.x, cluster.y, cluster.time, cluster.event, cluster.radius)            
+
+    '''
+    Push each queued report into its nearest cluster, or create a new cluster with the report
+        This scalar implementation is the reference of assign_reports_numpy
+    '''
+    def assign_reports(self):
         for report in self.report_queue:
+            candidates = self.candidates(report.lane.road, report.x, report.y)
+            
             min_distance = math.inf
             nearest_cluster = None
-            for cluster in self.cluster_list:
+            for cluster in candidates:
                 include, distance = cluster.include_report(report)
                 if include and (distance < min_distance):
                     nearest_cluster = cluster
@@ -227,38 +879,155 @@ class Batch():
             if nearest_cluster != None:
                 # If a nearest cluster exists, push the report into the cluster
                 nearest_cluster.insert(report)
+                self.shard_of(nearest_cluster).update(nearest_cluster)
+                self.track(report, nearest_cluster)
             else:
                 # Otherwise, create a new cluster with the report
-                self.cluster_list.append(Cluster(self.pygame, report))
-        
-        self.report_queue.clear()
+                cluster = Cluster(self.pygame, report, self.store)
+                self.add_cluster(cluster)
+                self.track(report, cluster)
 
-        self.combine_clusters()
-        
-        # print clusters
-        #for idx, cluster in enumerate(self.cluster_list):
-        #    print(idx, len(cluster.reports), cluster.x, cluster.y, cluster.time, cluster.event, cluster.radius)            
+    '''
+    Same as assign_reports, but distances from queued reports to clusters are computed at once,
+                        NUMPY_ENGINE_ROWS reports at a time, and only to clusters in shards that those reports can reach
+        Whenever a cluster changes or is created, only its column is recomputed for the remaining reports of the matrix,
+                        so the result is identical to that of assign_reports
+    '''
+    def assign_reports_numpy(self):
+        for first in range(0, len(self.report_queue), NUMPY_ENGINE_ROWS):
+            reports = self.report_queue[first:first+NUMPY_ENGINE_ROWS]
+            matrix = DistanceMatrix(reports, self.clusters_near(reports))
+            for idx, report in enumerate(reports):
+                column = matrix.nearest(idx)
+                if column != None:
+                    cluster = matrix.clusters[column]
+                    cluster.insert(report)
+                    self.shard_of(cluster).update(cluster)
+                    matrix.update_cluster(column, idx+1)
+                else:
+                    cluster = Cluster(self.pygame, report, self.store)
+                    self.add_cluster(cluster)
+                    matrix.add_cluster(cluster, idx+1)
+                self.track(report, cluster)
+
+    def track(self, report, cluster):   # Remember which cluster a report went into, to evict it later
+        if self.window != None:
+            self.window_queue.append((self.get_ticks(), report.index,\
+                                      report.x, report.y, report.time, report.event, report.count, cluster))
+
+    '''
+    Evict reports received at or before time_limit (in ms) from their clusters
+        Only the evicted reports are visited, and clusters left without reports are removed
+    '''
+    def evict(self, time_limit):
+        touched = {}
+        while len(self.window_queue) > 0 and self.window_queue[0][0] <= time_limit:
+            _, index, x, y, report_time, event, count, cluster = self.window_queue.popleft()
+            while cluster.merged_into != None:
+                cluster = cluster.merged_into
+            cluster.evict(index, x, y, report_time, event, count)
+            touched[cluster] = True
+            if self.store != None:
+                self.store.discard_before(index+1)
+
+        emptied = False
+        for cluster in touched:     # Dictionary keys keep the order of eviction, which keeps results reproducible
+            if cluster.count <= 0:
+                self.shard_of(cluster).remove(cluster)
+                emptied = True
+            else:
+                cluster.update_after_eviction()
+                self.shard_of(cluster).update(cluster)
+        if emptied:
+            self.cluster_list = [cluster for cluster in self.cluster_list if cluster.count > 0]
+
+    '''
+    Clusters are sharded by the road of their lanes,
+                        since a report or cluster on a road can be close only to those on compatible roads
+                        (see on_the_same_road)
+    '''
+    def shard_of(self, cluster):
+        road_id = cluster.lane.road.road_id     # None for all clusters if roads have no ids
+        if road_id not in self.shards:
+            self.shards[road_id] = ClusterGrid(CLUSTER_GRID_CELL)
+        return self.shards[road_id]
+
+    def add_cluster(self, cluster):
+        self.cluster_list.append(cluster)
+        self.shard_of(cluster).add(cluster)
+
+    '''
+    Return clusters on roads compatible with a road that might include a position,
+                        in the order of their creation (i.e., the order of cluster_list)
+    '''
+    def candidates(self, road, x, y):
+        if road.compatible_road_ids != None:
+            road_ids = road.compatible_road_ids
+        else:
+            road_ids = list(self.shards)
+
+        clusters = []
+        for road_id in road_ids:
+            if road_id in self.shards:
+                if USE_CLUSTER_GRID:
+                    clusters.extend(self.shards[road_id].candidates(x, y))
+                else:
+                    clusters.extend(self.shards[road_id].clusters)
+        return sorted(clusters, key=lambda cluster: cluster.id)
+
+    '''
+    Return clusters on roads compatible with the road of any of the given reports, in the order of cluster_list
+    '''
+    def clusters_near(self, reports):
+        road_ids = set()
+        for road in set(report.lane.road for report in reports):
+            if road.compatible_road_ids == None:
+                return list(self.cluster_list)
+            road_ids.update(road.compatible_road_ids)
+
+        clusters = []
+        for road_id in road_ids:
+            if road_id in self.shards:
+                clusters.extend(self.shards[road_id].clusters)
+        return sorted(clusters, key=lambda cluster: cluster.id)
     
+    '''
+    Combine clusters that include the centroid of one another
+        Every pair of clusters whose circles might contain the other's centroid is checked once,
+                        and chains of combinable clusters are resolved with union-find,
+                        so that each chain is combined into its oldest cluster
+    '''
     def combine_clusters(self):
-        for cluster in self.cluster_list:
-            cluster.combined = False      
-        
-        for i in range(0, len(self.cluster_list)-2):
-            c1 = self.cluster_list[i]
-            if c1.combined:
-                continue            
-            for j in range(i+1, len(self.cluster_list)-1):
-                c2 = self.cluster_list[j]
-                if c2.combined:
-                    continue                
-                if c1.include_cluster(c2) or c2.include_cluster(c1):
-                    c1.combine_with(c2)
-                    c2.combined = True
-                    print("two clusters combined")
-                    
+        parent = {cluster: cluster for cluster in self.cluster_list}
+        def find(cluster):
+            while parent[cluster] != cluster:
+                parent[cluster] = parent[parent[cluster]]   # Path halving
+                cluster = parent[cluster]
+            return cluster
+
+        # Find pairs of clusters to combine
+        for c1 in self.cluster_list:
+            for c2 in self.candidates(c1.lane.road, c1.x, c1.y):    # Clusters whose circles may contain the centroid of c1
+                if c2 == c1 or not c2.include_cluster(c1):
+                    continue
+                root1, root2 = find(c1), find(c2)
+                if root1 != root2:
+                    if root1.id < root2.id:
+                        parent[root2] = root1
+                    else:
+                        parent[root1] = root2
+
+        # Combine each cluster into the root of its chain, in the order of cluster_list
         new_cluster_list = []
         for cluster in self.cluster_list:
-            if not cluster.combined:
+            root = find(cluster)
+            if root == cluster:
                 new_cluster_list.append(cluster)
+            else:
+                root.combine_with(cluster)
+                cluster.merged_into = root
+                self.shard_of(cluster).remove(cluster)
+                self.shard_of(root).update(root)
+                print("two clusters combined")
 
         self.cluster_list = new_cluster_list
@@ -0,0 +1,50 @@
+import heapq
+import itertools
+
+'''
+Define a Scheduler object, which replaces pygame.time.set_timer with a heap of events in virtual time
+    Events due at the same time fire in the order in which they were registered,
+                    so a run depends only on the periods and the random seed, not on the speed of the CPU
+    now: virtual time in ms of the event being fired (or of the last one fired)
+'''
+class Scheduler():
+    def __init__(self, now=0):
+        self.now = now
+        self.events = []    # heap of (due time, registration order, period, handler)
+        self.order = itertools.count()
+        self.num_fired = 0
+
+    '''
+    Fire handler() every period ms, beginning at now + period (as pygame.time.set_timer does)
+    '''
+    def every(self, period, handler):
+        if period <= 0:
+            raise ValueError("Period of a periodic event must be positive: " + str(period))
+        heapq.heappush(self.events, (self.now + period, next(self.order), period, handler))
+
+    '''
+    Fire handler() once at the given time (not earlier than now)
+    '''
+    def at(self, due, handler):
+        heapq.heappush(self.events, (max(due, self.now), next(self.order), None, handler))
+
+    def get_ticks(self):    # Drop-in replacement of pygame.time.get_ticks
+        return self.now
+
+    '''
+    Fire all events due at or before end_time in order of (due time, registration order)
+        Periodic events keep their registration order, so ties among them are always broken the same way
+    '''
+    def run_until(self, end_time):
+        events = self.events
+        while len(events) > 0 and events[0][0] <= end_time:
+            due, order, period, handler = events[0]
+            self.now = due
+            if period != None:
+                heapq.heapreplace(events, (due + period, order, period, handler))
+            else:
+                heapq.heappop(events)
+            handler()
+            self.num_fired += 1
+        if end_time > self.now:
+            self.now = end_time
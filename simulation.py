@@ -0,0 +1,272 @@
+import random
+import traffic            # traffic.py needs to be in the same directory
+import report           # report.py needs to be in the same directory
+import demand           # demand.py needs to be in the same directory
+
+'''
+Define constants
+'''
+TIME_ADDCAR = 200  # Add a new car every 200 ms
+TIME_MOVECAR = 80 # Move car every 80 ms
+TIME_CHANGE_SIGNAL = 5000 # Change traffic signal bettwen RED and GREEN every 5,000 ms
+TIME_AMBER_SIGNAL = 1000
+TIME_BATCH = 20000  # Begin a new batch every 20,000 ms
+CONTINUOUS_CLUSTERING = False   # Instead of new batches, keep clusters and evict reports older than TIME_BATCH
+USE_DEMAND = False  # Instead of a car every TIME_ADDCAR ms, spawn cars arriving at DEMAND_RATE on every lane for new cars
+DEMAND_RATE = 0.5   # Cars per second per lane, or a schedule such as [(0, 0.5), (60, 2.0)] (see demand.rate_at)
+TIME_DEMAND = TIME_MOVECAR  # Spawn arrivals every 80 ms
+DIRTY_RECTS_MAX = 200   # paint_dirty_on repaints the whole screen if more areas than this have changed
+MAX_CATCHUP_STEPS = 5   # Moves of cars that Accumulator.advance simulates at most before the overload policy applies
+OVERLOAD_SLOW_DOWN = 1  # Simulate MAX_CATCHUP_STEPS moves and let simulated time fall behind the wall clock
+OVERLOAD_DROP_STEPS = 2 # Keep up with the wall clock, but skip the oldest moves beyond MAX_CATCHUP_STEPS
+OVERLOAD_DEFER_CLUSTERING = 3   # Simulate every move, but process reports only once after the last one
+OVERLOAD_POLICY = OVERLOAD_SLOW_DOWN
+
+MAX_SIGNAL_COUNT = int(TIME_CHANGE_SIGNAL / TIME_AMBER_SIGNAL)
+TIME_SIGNAL_COUNT = int(TIME_CHANGE_SIGNAL / MAX_SIGNAL_COUNT)     # Period of CHANGE_SIGNAL events
+
+'''
+Add or modify roads here
+'''
+def add_roads(pygame, font_street_name):
+    # Scenario 1 - two wide streets
+    roads = []
+    roads.append(traffic.Road(pygame, "Street #1", font_street_name, 100,\
+                              traffic.HORIZONTAL, [4,4]))
+    roads.append(traffic.Road(pygame, "Street #2", font_street_name, 350,\
+                              traffic.VERTICAL, [4,4]))
+
+    # Scenario 2 - four streets
+    '''
+    roads.append(traffic.Road(pygame, "Street #1", font_street_name, 100,\
+                              traffic.HORIZONTAL, [3,3]))
+    roads.append(traffic.Road(pygame, "Street #2", font_street_name, 700,\
+                              traffic.VERTICAL, [2,2]))
+    roads.append(traffic.Road(pygame, "Street #3", font_street_name, 300,\
+                              traffic.VERTICAL, [2,2]))
+    roads.append(traffic.Road(pygame, "Street #4", font_street_name, 350,\
+                              traffic.HORIZONTAL, [1,1]))
+    '''
+    return roads
+
+'''
+Register the periodic events of a simulation with a scheduler (see scheduler.py)
+    Events due at the same time fire in this order
+'''
+def add_timers(sim, clock):
+    if sim.demand != None:
+        clock.every(TIME_DEMAND, sim.add_arrivals)
+    else:
+        clock.every(TIME_ADDCAR, sim.add_car)
+    clock.every(TIME_MOVECAR, sim.move_cars)
+    clock.every(TIME_SIGNAL_COUNT, sim.change_signal)
+    clock.every(TIME_BATCH, sim.new_batch)
+
+'''
+Define an Accumulator object, which advances a simulation to the time that the wall clock asks for
+                        (as clock.run_until does), with at most MAX_CATCHUP_STEPS moves of cars per call
+    If more moves are due (e.g., after a slow frame), OVERLOAD_POLICY decides what to shed,
+                        so that catching up does not make the next call fall further behind
+    clock must begin at 0, so that the number of moves due by a time is time // TIME_MOVECAR
+'''
+class Accumulator():
+    def __init__(self, sim, clock):
+        self.sim = sim
+        self.clock = clock
+        self.lag = 0                # ms by which simulated time has fallen behind (see OVERLOAD_SLOW_DOWN)
+        self.num_overloads = 0      # Calls with more than MAX_CATCHUP_STEPS moves due
+
+    def advance(self, target):  # target: time in ms that the wall clock asks for (e.g., ms since pygame.init())
+        target = target - self.lag
+        due = int(target // TIME_MOVECAR) - self.sim.num_steps
+        deferred = False
+        if due > MAX_CATCHUP_STEPS:
+            self.num_overloads += 1
+            if OVERLOAD_POLICY == OVERLOAD_SLOW_DOWN:
+                end = (self.sim.num_steps + MAX_CATCHUP_STEPS) * TIME_MOVECAR
+                self.lag += target - end
+                target = end
+            elif OVERLOAD_POLICY == OVERLOAD_DROP_STEPS:
+                self.sim.steps_to_drop = due - MAX_CATCHUP_STEPS
+            elif OVERLOAD_POLICY == OVERLOAD_DEFER_CLUSTERING:
+                self.sim.defer_clustering = deferred = True
+        self.clock.run_until(target)
+        if deferred:
+            self.sim.defer_clustering = False
+            self.sim.process_deferred_reports()
+
+    def summary(self):
+        return "Overloads: " + str(self.num_overloads) + " frames, " + str(self.sim.num_steps_dropped) + " moves dropped, " +\
+               str(self.sim.num_steps_merged) + " moves clustered together, " + str(round(self.lag/1000, 1)) + " secs behind"
+
+'''
+Define a Simulation object, which holds roads, traffic signals, and clusters,
+                    and advances them upon each event (ADDCAR, MOVECAR, CHANGE_SIGNAL, and NEWBATCH)
+    Painting is a separate layer (paint_on and paint_dirty_on), so the simulation runs headless if pygame is None,
+                    in which case get_ticks must provide the current time in ms
+    Painting only reads the simulation, so a run is the same whether, or how often, it is painted
+    Roads do not change once intersections are added, so they are painted once on a background surface
+'''
+class Simulation():
+    def __init__(self, pygame=None, font_street_name=None, get_ticks=None):
+        self.pygame = pygame
+        self.get_ticks = get_ticks
+
+        self.roads = add_roads(pygame, font_street_name)
+        traffic.find_overlaps(self.roads)            # Sanity check
+        self.intersections = traffic.add_intersections(self.roads)
+        traffic.find_lanes_for_new_cars(self.roads)
+        if USE_DEMAND:
+            self.demand = demand.Demand(self.roads, DEMAND_RATE, TIME_DEMAND)    # Rates of lanes can be changed by set_rate
+        else:
+            self.demand = None
+
+        self.signal_count = 0
+        self.num_steps = 0      # Number of times cars have moved (or were due to move)
+        self.steps_to_drop = 0          # Moves to skip (see OVERLOAD_DROP_STEPS)
+        self.num_steps_dropped = 0
+        self.defer_clustering = False   # Leave reports in the queue after moves (see OVERLOAD_DEFER_CLUSTERING)
+        self.steps_deferred = 0         # Moves whose reports are left in the queue
+        self.num_steps_merged = 0       # Moves whose reports were processed together with those of later moves
+
+        self.background = None      # Surface with roads (see paint_on)
+        self.painted = None         # car -> (x, y, width, height, color) on the screen (see paint_dirty_on)
+        self.overlay = None         # What the batch and clusters look like on the screen (see find_overlay)
+        self.overlay_rects = []     # Areas of the batch and clusters on the screen
+
+        self.coalescer = report.ReportCoalescer()    # Coalesce repeated STOP reports (see report.COALESCE_POLICY)
+        if CONTINUOUS_CLUSTERING:
+            self.batch = report.Batch(pygame, 1, TIME_BATCH, self.coalescer, TIME_BATCH, get_ticks)
+        else:
+            self.batch = report.Batch(pygame, 1, TIME_BATCH, self.coalescer, None, get_ticks) # Create the first batch instance
+
+    def add_car(self):  # Add a new car on a regular basis
+        road = self.roads[random.randrange(0, len(self.roads))]
+        road.add_newCar()
+
+    def add_arrivals(self):     # Spawn cars that have arrived since the last call (see demand.Demand)
+        self.demand.spawn(self.get_ticks())
+
+    def move_cars(self):    # Move cars on a regular basis
+        self.num_steps += 1
+        if self.steps_to_drop > 0:
+            self.steps_to_drop -= 1
+            self.num_steps_dropped += 1
+            return
+        for road in self.roads:
+            road.move(self.batch)
+        for road in self.roads:     # Cars that have changed lanes move onto the centers of their new lanes
+            for lane in road.lanes:
+                lane.align_cars()
+        if self.defer_clustering:
+            self.steps_deferred += 1
+        else:
+            self.batch.process_reports()     # Process reports
+
+    def process_deferred_reports(self):     # Process the reports of deferred moves at once
+        if self.steps_deferred > 0:
+            self.num_steps_merged += self.steps_deferred - 1    # All but the last of them are merged with later moves
+            self.steps_deferred = 0
+        self.batch.process_reports()
+
+    def change_signal(self):    # Change traffic signal at intersections
+        self.signal_count = (self.signal_count + 1) % MAX_SIGNAL_COUNT
+        if self.signal_count == MAX_SIGNAL_COUNT - 1:
+            for it in self.intersections:
+                # Disallow entrance to all lanes during AMBER period
+                for lane in it.signal_group[it.current_signal]:
+                    lane.trafficLight = traffic.REDLIGHT
+        elif self.signal_count == 0:
+            for it in self.intersections:
+                it.current_signal = (it.current_signal + 1) % len(it.signal_group)
+                # Allow entrance to lanes with GREEN light
+                for lane in it.signal_group[it.current_signal]:
+                    lane.trafficLight = traffic.GO
+
+    def new_batch(self):    # Begin a new batch
+        if CONTINUOUS_CLUSTERING:
+            return
+        if self.defer_clustering:
+            self.process_deferred_reports()     # Reports deferred by Accumulator belong to this batch
+        if self.coalescer.policy != report.COALESCE_NONE:
+            print(self.coalescer.summary())
+        if self.demand != None:
+            print(self.demand.summary())
+        self.batch = report.Batch(self.pygame, self.batch.batch_num+1, TIME_BATCH, self.coalescer, None, self.get_ticks)
+
+    def toggle_accident_at(self, x, y):     # Create/release an accident at a position
+        car = traffic.find_car_nearest_to_mouse_pos(self.roads, x, y)
+        if car != None:
+            car.toggle_accident(self.batch)
+            self.batch.process_reports()     # Process reports
+        else:
+            print("No car found on the lane at mouse position")
+
+    def paint_on(self, screen):     # Repaint the whole screen
+        if self.background == None:
+            self.background = self.pygame.Surface(screen.get_size())
+            self.background.fill(traffic.SCREEN_COLOR)  # Fill the background with white
+            for road in self.roads:
+                road.paint_on(self.background)
+        screen.blit(self.background, (0, 0))
+        for road in self.roads:
+            road.paint_cars_on(screen)
+        self.overlay_rects = self.batch.paint_on(screen)
+        self.overlay = self.find_overlay()
+        self.painted = None
+
+    '''
+    Repaint only areas that have changed since the last call, i.e.,
+                        the old and new areas of cars that have moved, changed colors, entered, or left
+        The batch and clusters, which are painted on top of cars, are repainted as a whole (with cars beneath them)
+                        if they have changed or any of those areas overlaps them
+    Return the areas to pass to pygame.display.update
+    '''
+    def paint_dirty_on(self, screen):
+        if self.painted == None:
+            self.paint_on(screen)
+            self.painted = self.find_painted()
+            return [screen.get_rect()]
+
+        painted = self.find_painted()
+        dirty = []
+        for car, state in painted.items():
+            old = self.painted.pop(car, None)
+            if old != state:
+                dirty.append(self.pygame.Rect(state[:4]))
+                if old != None:
+                    dirty.append(self.pygame.Rect(old[:4]))
+        for old in self.painted.values():   # Cars that have left the screen
+            dirty.append(self.pygame.Rect(old[:4]))
+        overlay = self.find_overlay()
+        repaint_overlay = overlay != self.overlay or any(rect.collidelist(self.overlay_rects) >= 0 for rect in dirty)
+        if repaint_overlay:
+            dirty.extend(self.overlay_rects)
+        if len(dirty) > DIRTY_RECTS_MAX:
+            self.paint_on(screen)
+            self.painted = painted
+            return [screen.get_rect()]
+
+        for rect in dirty:
+            screen.blit(self.background, rect, rect)
+        for car in painted:
+            if car.rect.collidelist(dirty) >= 0:    # Including cars that have not changed but are partly erased
+                car.paint_on(screen)
+        if repaint_overlay:
+            self.overlay_rects = self.batch.paint_on(screen)
+            self.overlay = overlay
+            dirty.extend(self.overlay_rects)
+        self.painted = painted
+        return dirty
+
+    def find_overlay(self):
+        return self.batch, self.batch.label(),\
+               [(c.x, c.y, c.radius, c.color, c.count) for c in self.batch.cluster_list if c.is_painted()]
+
+    def find_painted(self):
+        painted = {}
+        for road in self.roads:
+            for lane in road.lanes:
+                for car in lane.cars:
+                    painted[car] = (car.rect.x, car.rect.y, car.rect.w, car.rect.h, car.color)
+        return painted
@@ -0,0 +1,61 @@
+import random
+import pytest
+import report           # report.py needs to be in the same directory
+import simulation       # simulation.py needs to be in the same directory
+import scheduler        # scheduler.py needs to be in the same directory
+
+'''
+Test that every way to find and store clusters gives the same clusters as the reference
+                        (the scalar path with the grid index and columnar storage, see report.Batch.assign_reports)
+    Headless runs with dense traffic and accidents defer clustering for 20 of every 100 moves
+                        (see simulation.OVERLOAD_DEFER_CLUSTERING), so that some ticks queue many reports at once
+'''
+def find_clusters(sim):     # Ids are left out, as they keep counting across runs
+    return [(cluster.x, cluster.y, cluster.radius, cluster.count) for cluster in sim.batch.cluster_list]
+
+def run(seed):
+    random.seed(seed)
+    clock = scheduler.Scheduler()
+    sim = simulation.Simulation(get_ticks=clock.get_ticks)
+    simulation.add_timers(sim, clock)
+    rng = random.Random(seed)   # Accidents do not change the random numbers of the simulation
+    states = []
+    for step in range(1, 300):
+        sim.defer_clustering = step % 100 >= 80
+        clock.run_until(step * simulation.TIME_MOVECAR)
+        if step % 100 == 99:
+            sim.process_deferred_reports()
+        if step % 150 == 0:
+            cars = [car for road in sim.roads for lane in road.lanes for car in lane.cars]
+            if len(cars) > 0:
+                rng.choice(cars).toggle_accident(sim.batch)
+                sim.batch.process_reports()
+        states.append(find_clusters(sim))
+    return states
+
+@pytest.mark.parametrize('seed', [1, 3])
+@pytest.mark.parametrize('options', [
+    {'USE_NUMPY_ENGINE': True, 'NUMPY_ENGINE_ROWS': 7, 'NUMPY_ENGINE_COLUMNS': 1},     # Many blocks, and matrices grow
+    {'USE_NUMPY_ENGINE': True, 'NUMPY_ENGINE_ROWS': 64, 'NUMPY_ENGINE_COLUMNS': 1},
+    {'USE_CLUSTER_GRID': False},                        # Scan all clusters on compatible roads
+    {'REPORT_STORAGE': report.STORAGE_OBJECTS},
+])
+def test_same_clusters(monkeypatch, seed, options):
+    if options.get('USE_NUMPY_ENGINE'):
+        pytest.importorskip('numpy')
+    monkeypatch.setattr(simulation, 'USE_DEMAND', True)
+    monkeypatch.setattr(simulation, 'DEMAND_RATE', 1.0)
+    states = run(seed)
+    assert sum(len(state) for state in states) > 0
+    for name, value in options.items():
+        monkeypatch.setattr(report, name, value)
+    assert run(seed) == states
+
+@pytest.mark.parametrize('seed', [1, 3])
+def test_incremental_radius(monkeypatch, seed):    # Bounds decide as exact radii do, so only radii differ (see Cluster.includes)
+    monkeypatch.setattr(simulation, 'USE_DEMAND', True)
+    monkeypatch.setattr(simulation, 'DEMAND_RATE', 1.0)
+    states = [[cluster[:2] + cluster[3:] for cluster in state] for state in run(seed)]
+    monkeypatch.setattr(report, 'CLUSTER_RADIUS_MODE', report.RADIUS_INCREMENTAL)
+    monkeypatch.setattr(report, 'CLUSTER_RADIUS_CHECK', True)
+    assert [[cluster[:2] + cluster[3:] for cluster in state] for state in run(seed)] == states
@@ -0,0 +1,54 @@
+import random
+import pytest
+import traffic            # traffic.py needs to be in the same directory
+import simulation       # simulation.py needs to be in the same directory
+import scheduler        # scheduler.py needs to be in the same directory
+
+'''
+Test that painting does not change the simulation, so render modes of clustering_simulation.py run the same traffic
+    The main loop is replayed with frames every 1000/30 ms of simulated time, painted on an offscreen surface
+'''
+RENDER_FRAME = 1
+RENDER_STEPS = 2
+RENDER_NONE = 3
+
+def find_state(sim):     # Ids are left out, as they keep counting across runs
+    lanes = [lane for road in sim.roads for lane in road.lanes]
+    cars = [(idx, car.rect.x, car.rect.y, car.color, car.accident) for idx, lane in enumerate(lanes) for car in lane.cars]
+    clusters = [(cluster.x, cluster.y, cluster.radius, cluster.count) for cluster in sim.batch.cluster_list]
+    return cars, clusters
+
+def run(pygame, seed, render_mode, dirty_rects):
+    random.seed(seed)
+    timers = scheduler.Scheduler()
+    sim = simulation.Simulation(pygame, pygame.font.SysFont(None, traffic.LANE_WIDTH), timers.get_ticks)
+    simulation.add_timers(sim, timers)
+    steps = simulation.Accumulator(sim, timers)
+    screen = pygame.Surface((traffic.SCREEN_WIDTH, traffic.SCREEN_HEIGHT))
+    rng = random.Random(seed)   # Accidents do not change the random numbers of the simulation
+
+    rendered_step = 0
+    for frame in range(1, 1200):
+        steps.advance(frame * 1000 / 30)
+        if frame % 150 == 0:
+            cars = [car for road in sim.roads for lane in road.lanes for car in lane.cars]
+            if len(cars) > 0:
+                rng.choice(cars).toggle_accident(sim.batch)
+                sim.batch.process_reports()
+        if render_mode == RENDER_FRAME or (render_mode == RENDER_STEPS and sim.num_steps >= rendered_step + 3):
+            rendered_step = sim.num_steps
+            if dirty_rects:
+                sim.paint_dirty_on(screen)
+            else:
+                sim.paint_on(screen)
+    return find_state(sim)
+
+@pytest.mark.parametrize('seed', [1, 5])
+def test_render_modes(seed):
+    pygame = pytest.importorskip('pygame')
+    pygame.font.init()
+    state = run(pygame, seed, RENDER_NONE, False)
+    assert len(state[0]) > 0
+    assert run(pygame, seed, RENDER_FRAME, True) == state
+    assert run(pygame, seed, RENDER_FRAME, False) == state
+    assert run(pygame, seed, RENDER_STEPS, True) == state
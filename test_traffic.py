@@ -0,0 +1,49 @@
+import random
+import pytest
+import traffic            # traffic.py needs to be in the same directory
+import report           # report.py needs to be in the same directory
+import simulation       # simulation.py needs to be in the same directory
+import scheduler        # scheduler.py needs to be in the same directory
+
+'''
+Property test of the position keys of lanes (see traffic.Lane.position_keys)
+    Headless runs with random spawns, moves, accidents, and lane changes check after every move of cars that
+                        the keys of each lane are sorted from the front to the back and match the cars on the lane
+'''
+def check_lanes(sim):
+    for road in sim.roads:
+        for lane in road.lanes:
+            keys = list(lane.position_keys())
+            assert keys == [lane.key_of(car) for car in lane.cars], 'keys of lane ' + str(lane.lane_id) + ' are stale'
+            assert keys == sorted(keys), 'cars on lane ' + str(lane.lane_id) + ' are out of order'
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('numpy_lanes', [False, True])
+def test_lane_order(monkeypatch, seed, numpy_lanes):
+    monkeypatch.setattr(traffic, 'CAR_CHANGE_LANE_RATE_BLOCKED', 0.5)     # Change lanes more often than usual
+    monkeypatch.setattr(traffic, 'USE_NUMPY_LANES', numpy_lanes)
+    monkeypatch.setattr(traffic, 'NUMPY_LANE_MIN_CARS', 4)
+    monkeypatch.setattr(report, 'CLUSTER_KEEP_REPORTS', False)  # Keep clustering cheap in congestion
+    if numpy_lanes:
+        pytest.importorskip('numpy')
+
+    num_lane_changes = [0]
+    insert_car = traffic.Lane.insert_car
+    def count_lane_changes(lane, idx, car):
+        num_lane_changes[0] += 1
+        insert_car(lane, idx, car)
+    monkeypatch.setattr(traffic.Lane, 'insert_car', count_lane_changes)
+
+    random.seed(seed)
+    clock = scheduler.Scheduler()
+    sim = simulation.Simulation(get_ticks=clock.get_ticks)
+    simulation.add_timers(sim, clock)
+    rng = random.Random(seed)   # Accidents do not change the random numbers of the simulation
+    for step in range(1, 750):
+        clock.run_until(step * simulation.TIME_MOVECAR)
+        if step % 50 == 0:
+            cars = [car for road in sim.roads for lane in road.lanes for car in lane.cars]
+            if len(cars) > 0:
+                rng.choice(cars).toggle_accident(sim.batch)
+        check_lanes(sim)
+    assert num_lane_changes[0] > 0
@@ -1,8 +1,13 @@
-import pygame
 import random
 import itertools
+import bisect
 import report
 import math
+from array import array
+try:
+    import numpy    # Optional, used by the array-based lane kernel
+except ImportError:
+    numpy = None
 
 '''
 Define constants
@@ -13,6 +18,8 @@ SCREEN_COLOR = (0, 0, 0) # Black
 LANE_WIDTH = 19
 LANE_COLOR = (220, 220, 220) # Gray
 LANE_NAME_COLOR = (255, 255, 255) # White
+ROAD_NAME_WIDTH = 54    # Space for the name before the lanes of a vertical road, with or without a font
+ROAD_NAME_HEIGHT = 13   # Space for the name above the lanes of a horizontal road (both fit "Street #1" in pygame's default font of size LANE_WIDTH)
 
 HORIZONTAL = 1
 VERTICAL = 2
@@ -20,6 +27,9 @@ TO_LEFT = 3
 TO_RIGHT= 4
 TO_BOTTOM = 5
 TO_TOP = 6
+# Sign of progress along a lane, and the front and rear sides of cars on it, for each direction (see Lane)
+DIRECTION_SIDES = {TO_LEFT: (-1, 'left', 'right'), TO_RIGHT: (1, 'right', 'left'),
+                   TO_BOTTOM: (1, 'bottom', 'top'), TO_TOP: (-1, 'top', 'bottom')}
 
 GO = 100
 REDLIGHT = 101  # Red light
@@ -30,10 +40,116 @@ CAR_LENGTH = 20
 CAR_COLOR = (50, 200, 50) # Greenish
 CAR_COLOR_ACCIDENT = (200, 50, 50) # Redish
 CAR_COLOR_VAR = 50
+CAR_COLOR_STEP = 10     # Color components of cars are rounded down to multiples of this, so cars share sprites
 CAR_SPEED = 10
 CAR_SPEED_VAR = 3
 CAR_SAFE_DISTANCE = CAR_LENGTH * 1.5
 CAR_CHANGE_LANE_RATE_BLOCKED = 0.2  # Rate of chaining lanes when blocked
+USE_NUMPY_LANES = True          # Move cars in free flow on long lanes with NumPy arrays (requires numpy)
+NUMPY_LANE_MIN_CARS = 64        # Lanes with fewer cars move them one by one, which is faster for short lanes
+USE_LANE_OCCUPANTS = True       # Keep the cars on crossing lanes that occupy each lane until those lanes change
+CHECK_LANE_ORDER = False        # Check that cars on each lane remain sorted from the front to the back (slow)
+USE_SLEEPING_CARS = True        # Replay the last move of a stopped car until the preceding car, neighbor lanes, or traffic lights change
+
+lane_ids = itertools.count()    # Plain integer ids, e.g., for report.ReportStore
+car_ids = itertools.count()
+car_colors = {}     # Shared color tuples of cars (see new_car_color)
+car_sprites = {}    # Shared surfaces filled with a color, keyed by (color, size) (see Car.paint_on)
+
+
+'''
+Define a Rect object, which replaces pygame.Rect when pygame is not used (i.e., headless runs)
+    Like pygame.Rect, coordinates are integers:
+                        the constructor and update() truncate their arguments,
+                        whereas assignments to attributes round values half away from zero
+'''
+def round_half_away(value):
+    if isinstance(value, int):
+        return value
+    return int(value + 0.5) if value >= 0 else -int(-value + 0.5)
+
+class Rect():
+    __slots__ = ('x', 'y', 'w', 'h')
+
+    def __init__(self, left, top, width, height):
+        self.update(left, top, width, height)
+
+    def update(self, left, top, width, height):
+        self.x = int(left)
+        self.y = int(top)
+        self.w = int(width)
+        self.h = int(height)
+
+    def __repr__(self):
+        return '<rect(' + str(self.x) + ', ' + str(self.y) + ', ' + str(self.w) + ', ' + str(self.h) + ')>'
+
+    @property
+    def left(self):
+        return self.x
+    @left.setter
+    def left(self, value):
+        self.x = round_half_away(value)
+
+    @property
+    def top(self):
+        return self.y
+    @top.setter
+    def top(self, value):
+        self.y = round_half_away(value)
+
+    @property
+    def right(self):
+        return self.x + self.w
+    @right.setter
+    def right(self, value):
+        self.x = round_half_away(value) - self.w
+
+    @property
+    def bottom(self):
+        return self.y + self.h
+    @bottom.setter
+    def bottom(self, value):
+        self.y = round_half_away(value) - self.h
+
+    @property
+    def centerx(self):
+        return self.x + self.w // 2
+    @centerx.setter
+    def centerx(self, value):
+        self.x = round_half_away(value) - self.w // 2
+
+    @property
+    def centery(self):
+        return self.y + self.h // 2
+    @centery.setter
+    def centery(self, value):
+        self.y = round_half_away(value) - self.h // 2
+
+    @property
+    def center(self):
+        return (self.centerx, self.centery)
+    @center.setter
+    def center(self, value):
+        self.centerx, self.centery = value
+
+    @property
+    def width(self):
+        return self.w
+
+    @property
+    def height(self):
+        return self.h
+
+'''
+Create a pygame.Rect, or a Rect if pygame is None, with the given size and center
+'''
+def new_rect(pygame, width, height, center):
+    if pygame != None:
+        rect = pygame.Rect(0, 0, width, height)
+    else:
+        rect = Rect(0, 0, width, height)
+    rect.center = center
+    return rect
 
 
 '''
@@ -47,14 +163,22 @@ class Road():
                             # of to-bottom and to-top lanes for a VERTICAL road
     position: top y coordinate for a horizontal road
                      left x coordinate for a vertical road
+    pygame and font can be None for headless runs, which never paint
+    Lanes are placed regardless of the name and font (see ROAD_NAME_WIDTH), so a longer name is painted over lanes
     '''
     def __init__(self, pygame, name, font, position, orientation, num_lanes):
         self.pygame = pygame
-        self.name = font.render(name, True, LANE_NAME_COLOR)
+        if font != None:
+            self.name = font.render(name, True, LANE_NAME_COLOR)
+        else:
+            self.name = None
         self.name_str = name
         self.position = position
         self.intersections = []
         self.lanes_for_new_cars = []
+        self.road_id = None             # Assigned by add_intersections
+        self.compatible_roads = None    # compatible_roads[road_id] is True if on_the_same_road_with(road)
+        self.compatible_road_ids = None # road_id of every road for which compatible_roads is True
         
         if orientation != HORIZONTAL and orientation != VERTICAL:
             raise ValueError('Illegal orientation is used')
@@ -72,14 +196,14 @@ class Road():
         self.lanes = []        
         if self.orientation == HORIZONTAL:
             for idx in range(num_lanes[0]):
-                self.lanes.append(Lane(pygame, TO_LEFT, position + (self.name.get_height() + 2) + idx * (LANE_WIDTH+1), self))
+                self.lanes.append(Lane(pygame, TO_LEFT, position + (ROAD_NAME_HEIGHT + 2) + idx * (LANE_WIDTH+1), self))
             for idx in range(num_lanes[1]):
-                self.lanes.append(Lane(pygame, TO_RIGHT, position + (self.name.get_height() + 2) + (idx+num_lanes[0]) * (LANE_WIDTH+1), self))
+                self.lanes.append(Lane(pygame, TO_RIGHT, position + (ROAD_NAME_HEIGHT + 2) + (idx+num_lanes[0]) * (LANE_WIDTH+1), self))
         elif self.orientation == VERTICAL:
             for idx in range(num_lanes[0]):
-                self.lanes.append(Lane(pygame, TO_BOTTOM, position + (self.name.get_width() + 2) + idx * (LANE_WIDTH+1), self))
+                self.lanes.append(Lane(pygame, TO_BOTTOM, position + (ROAD_NAME_WIDTH + 2) + idx * (LANE_WIDTH+1), self))
             for idx in range(num_lanes[1]):
-                self.lanes.append(Lane(pygame, TO_TOP, position + (self.name.get_width() + 2) + (idx+num_lanes[1]) * (LANE_WIDTH+1), self))  
+                self.lanes.append(Lane(pygame, TO_TOP, position + (ROAD_NAME_WIDTH + 2) + (idx+num_lanes[1]) * (LANE_WIDTH+1), self))  
 
         configure_lanes_before_after(self.lanes)
         
@@ -179,21 +303,29 @@ class Lane():
     Constructor of a Lane object
     position: top y coordinate for a horizontal lane
                      left x coordinate for a vertical lane
+    The direction is resolved once here: positions along the lane are handled as progress,
+                        i.e., coordinates multiplied by self.sign, which increases toward the end of the lane,
+                        and the sides of cars are accessed by name (self.front, self.rear, self.low, and self.high),
+                        so that moving cars takes the same code in every direction
     '''
     def __init__(self, pygame, direction, position, road):
         self.pygame = pygame
+        self.lane_id = next(lane_ids)
 
         # Position the lane and get its Rectangle object
         self.direction = direction
         self.position = position
         self.center = position + LANE_WIDTH/2
         if self.direction == TO_LEFT or self.direction == TO_RIGHT:
-            self.surf = pygame.Surface((SCREEN_WIDTH, LANE_WIDTH))  # X/Y size
-            self.rect = self.surf.get_rect(center=(SCREEN_WIDTH/2, self.center))            
+            self.rect = new_rect(pygame, SCREEN_WIDTH, LANE_WIDTH, (SCREEN_WIDTH/2, self.center))  # X/Y size
         elif self.direction == TO_BOTTOM or self.direction == TO_TOP:
-            self.surf = pygame.Surface((LANE_WIDTH, SCREEN_HEIGHT))  # X/Y size
-            self.rect = self.surf.get_rect(center=(self.center, SCREEN_HEIGHT/2))            
-        self.surf.fill(LANE_COLOR)
+            self.rect = new_rect(pygame, LANE_WIDTH, SCREEN_HEIGHT, (self.center, SCREEN_HEIGHT/2))  # X/Y size
+        self.sign, self.front, self.rear = DIRECTION_SIDES[direction]
+        if self.direction == TO_LEFT or self.direction == TO_RIGHT:
+            self.low, self.high = 'left', 'right'
+        else:
+            self.low, self.high = 'top', 'bottom'
+        self.update_progress()
 
         self.road = road
         self.cars = []
@@ -203,12 +335,23 @@ class Lane():
         self.trafficLight = GO
 
         self.blocking_lanes = []                 # Other lanes that cross (thus possibly block) this lane
+        self.version = 0                    # Incremented whenever cars enter, leave, or move on this lane
+        self.occupants = []                 # Cars on blocking lanes that this lane includes (see find_occupants)
+        self.occupants_versions = None      # Versions of blocking lanes when occupants were found
+        self.keys = array('l')              # Position of each car, increasing from the front to the back (see position_keys)
+        self.keys_version = None            # Version of this lane when keys were computed
+        self.dependencies = None            # Lanes that can decide whether cars on this lane move (see find_dependencies)
 
     def update_size(self, left, top, width, height):
         self.rect.update(left, top, width, height)
-        self.surf = pygame.transform.scale(self.surf, (width, height))        
+        self.update_progress()
+
+    def update_progress(self):  # Progress at the beginning and the end of this lane
+        self.begin = self.sign * getattr(self.rect, self.rear)
+        self.end = self.sign * getattr(self.rect, self.front)
     
-    def add_newCar(self):
+    def add_newCar(self):   # Return True if a car has entered this lane (i.e., the entrance is clear)
+        num_cars = len(self.cars)
         if self.direction == TO_LEFT and self.rect.right == SCREEN_WIDTH:
             if (len(self.cars) == 0) or (self.cars[-1].rect.right < self.rect.right - CAR_SAFE_DISTANCE):
                 self.cars.append(Car(self.pygame, self.road, self, self.rect.right - CAR_LENGTH/2, self.center))
@@ -221,34 +364,82 @@ class Lane():
         elif self.direction == TO_TOP and self.rect.bottom == SCREEN_HEIGHT:
             if (len(self.cars) == 0) or (self.cars[-1].rect.bottom < self.rect.bottom - CAR_SAFE_DISTANCE):
                 self.cars.append(Car(self.pygame, self.road, self, self.center, self.rect.bottom - CAR_LENGTH/2))
+        if len(self.cars) != num_cars:
+            self.version += 1
+            return True
+        return False
          
     def paint_on(self, screen):
-        screen.blit(self.surf, self.rect)        
+        screen.fill(LANE_COLOR, self.rect)  # Same as blitting a lane-sized surface filled with LANE_COLOR
 
     def paint_cars_on(self, screen):
         for car in self.cars:
-            # Adjust each car's center to the lane's center, as the car might have changed lanes
+            car.paint_on(screen)
+
+    def align_cars(self):   # Adjust each car's center to the lane's center, as the car might have changed lanes (see Simulation.move_cars)
+        for car in self.cars:
             if self.direction == TO_LEFT or self.direction == TO_RIGHT:
-                car.rect.centery = self.center      
+                if car.rect.centery != self.center:
+                    car.rect.centery = self.center      
+                    self.version += 1
             elif self.direction == TO_BOTTOM or self.direction == TO_TOP:
-                car.rect.centerx = self.center
-            car.paint_on(screen)
+                if car.rect.centerx != self.center:
+                    car.rect.centerx = self.center
+                    self.version += 1
             
     def move(self, batch):
-        # Initialize position of preceding car for keeping a safe distance between consecutive cars
-        if self.direction == TO_LEFT:
-            self.x_preceding_car = self.rect.left - (CAR_SAFE_DISTANCE * 2)            
-        elif self.direction == TO_RIGHT:
-            self.x_preceding_car = self.rect.right + (CAR_SAFE_DISTANCE * 2)
-        elif self.direction == TO_BOTTOM:
-            self.y_preceding_car = self.rect.bottom + (CAR_SAFE_DISTANCE * 2)
-        elif self.direction == TO_TOP:
-            self.y_preceding_car = self.rect.top - (CAR_SAFE_DISTANCE * 2)            
-
+        # Initialize progress of preceding car's rear for keeping a safe distance between consecutive cars
+        self.preceding_car = self.end + (CAR_SAFE_DISTANCE * 2)
         self.status_preceding_car = GO
         
         # Move each car on the lane
-        self.cars = [car for car in self.cars if car.move(batch)]        # Only cars visible on the screen remain in the list
+        num_cars = len(self.cars)
+        if USE_NUMPY_LANES and numpy != None and len(self.cars) >= NUMPY_LANE_MIN_CARS and len(self.blocking_lanes) == 0:
+            self.cars = self.move_numpy(batch)
+        else:
+            self.cars = [car for car in self.cars if car.move(batch)]        # Only cars visible on the screen remain in the list
+        if len(self.cars) != num_cars:
+            self.version += 1   # Cars have left (Car.move increments the version when a car moves)
+
+    '''
+    Move cars as move() does, but move runs of cars in free flow with array operations
+        A car is in free flow if it is not in an accident, does not come near the end of the lane, and
+                        keeps a safe distance from the preceding car, which also moves at its speed
+        Other cars (e.g., blocked ones or those leaving the lane) move one by one with Car.move
+    '''
+    def move_numpy(self, batch):
+        cars = self.cars
+        sign, front = self.sign, self.front
+
+        fronts = numpy.array([getattr(car.rect, front) for car in cars])
+        speeds = numpy.array([car.speed for car in cars])
+        accidents = numpy.array([car.accident for car in cars], dtype=bool)
+        reach = sign * fronts + speeds      # Progress of each car's front after moving at its speed
+        free = ~accidents & (reach < self.end - CAR_SAFE_DISTANCE)
+        follows = numpy.zeros(len(cars), dtype=bool)    # Free flow, given that the preceding car is in free flow
+        follows[1:] = free[1:] & (reach[1:] <= reach[:-1] - CAR_LENGTH - CAR_SAFE_DISTANCE)
+        run_ends = numpy.flatnonzero(~follows).tolist() + [len(cars)]
+        new_fronts = (fronts + sign * speeds).tolist()
+        free = free.tolist()
+        reach = reach.tolist()
+
+        remaining = []
+        idx = 0
+        while idx < len(cars):
+            if free[idx] and reach[idx] <= self.preceding_car - CAR_SAFE_DISTANCE:   # GO, and so are cars following in free flow
+                idx_end = run_ends[bisect.bisect_right(run_ends, idx)]
+                for idx_car in range(idx, idx_end):
+                    setattr(cars[idx_car].rect, front, new_fronts[idx_car])
+                remaining.extend(cars[idx:idx_end])
+                self.version += 1
+                self.preceding_car = reach[idx_end-1] - CAR_LENGTH
+                self.status_preceding_car = GO
+                idx = idx_end
+            else:
+                if cars[idx].move(batch):
+                    remaining.append(cars[idx])
+                idx += 1
+        return remaining
 
     '''
     Return (True, idx) if car can be inserted into this lane's cars[idx]
@@ -256,163 +447,143 @@ class Lane():
     '''
     def can_change_lane(self, car, add):
         safe_distance = CAR_SAFE_DISTANCE * 2
-        
-        if self.direction == TO_LEFT:
-            # Check to see if cars on this lane blocks entrance
-            id_nearest_car = self.find_nearest_car_to_left(car, 0, len(self.cars)-1)
-            if ( (id_nearest_car >= 0) and (car.rect.left < self.cars[id_nearest_car].rect.right + safe_distance) ) or\
-               ( (id_nearest_car+1 < len(self.cars)) and (self.cars[id_nearest_car+1].rect.left - safe_distance < car.rect.right)):
+        sign, front, rear = self.sign, self.front, self.rear
+        car_front = sign * getattr(car.rect, front)
+
+        # Check to see if cars on this lane blocks entrance
+        id_nearest_car = self.find_nearest_car(car)
+        if ( (id_nearest_car >= 0) and (sign * getattr(self.cars[id_nearest_car].rect, rear) - safe_distance < car_front) ) or\
+           ( (id_nearest_car+1 < len(self.cars)) and\
+             (sign * getattr(car.rect, rear) < sign * getattr(self.cars[id_nearest_car+1].rect, front) + safe_distance) ):
+            return False, None
+
+        # Check to see if cars on lanes that cross this lane blocks entrance
+        for c in self.find_occupants():
+            if not car.outside_safe_distance_from(c, safe_distance, self.low, self.high):
                 return False, None
-            
-            # Check to see if cars on lanes that cross this lane blocks entrance
-            for blocking_lane in self.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.include_car(c) and not car.outside_safe_distance_from(c, safe_distance, self.direction):
-                        return False, None
 
-            # Check to see if cars on this lane's next lane blocks entrance        
-            if car.rect.left - car.speed <= self.rect.left + safe_distance:
-                for next_lane in self.next:
-                    if next_lane.trafficLight == REDLIGHT and car.rect.left < next_lane.rect.right + safe_distance:
-                        return False, None
-                    if len(next_lane.cars) > 0 and car.rect.left < next_lane.cars[-1].rect.right + safe_distance:
+        # Check to see if cars on this lane's next lane blocks entrance
+        if self.end - safe_distance <= car_front + car.speed:
+            for next_lane in self.next:
+                if next_lane.trafficLight == REDLIGHT and next_lane.begin - safe_distance < car_front:
+                    return False, None
+                if len(next_lane.cars) > 0 and sign * getattr(next_lane.cars[-1].rect, rear) - safe_distance < car_front:
+                    return False, None
+                for c in next_lane.find_occupants():
+                    if sign * getattr(c.rect, rear) - safe_distance < car_front:
                         return False, None
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c) and car.rect.left < c.rect.right + safe_distance:
-                                return False, None
 
-            return True, id_nearest_car+1
-        
-        elif self.direction == TO_RIGHT:
-            # Check to see if cars on this lane blocks entrance
-            id_nearest_car = self.find_nearest_car_to_right(car, 0, len(self.cars)-1)
-            if ( (id_nearest_car >= 0) and (self.cars[id_nearest_car].rect.left - safe_distance < car.rect.right ) ) or\
-               ( (id_nearest_car+1 < len(self.cars)) and (car.rect.left < self.cars[id_nearest_car+1].rect.right + safe_distance)):
-                return False, None
+        return True, id_nearest_car+1
 
-            # Check to see if cars on lanes that cross this lane blocks entrance
-            for blocking_lane in self.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.include_car(c) and not car.outside_safe_distance_from(c, safe_distance, self.direction):
-                        return False, None
+    '''
+    Return the position of a car on this lane as a key that increases from the front to the back of the lane
+    '''
+    def key_of(self, car):
+        return -self.sign * getattr(car.rect, self.low)
 
-            # Check to see if cars on this lane's next lane blocks entrance                
-            if self.rect.right - safe_distance <= car.rect.right + car.speed:
-                for next_lane in self.next:
-                    if next_lane.trafficLight == REDLIGHT and next_lane.rect.left - safe_distance < car.rect.right:
-                        return False, None
-                    if len(next_lane.cars) > 0 and next_lane.cars[-1].rect.left - safe_distance < car.rect.right:
-                        return False, None
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c) and c.rect.left - safe_distance < car.rect.right:
-                                return False, None
+    '''
+    Return the keys of cars on this lane in the order of self.cars
+        Keys are recomputed only after cars have entered, left, or moved on this lane (see self.version)
+    '''
+    def position_keys(self):
+        if self.keys_version != self.version:
+            self.keys = array('l', [self.key_of(car) for car in self.cars])
+            self.keys_version = self.version
+            if CHECK_LANE_ORDER:
+                for idx in range(len(self.keys) - 1):
+                    if self.keys[idx] > self.keys[idx+1]:
+                        raise ValueError('Cars ' + str(self.cars[idx].car_id) + ' and ' + str(self.cars[idx+1].car_id) +\
+                                         ' on lane ' + str(self.lane_id) + ' are out of order')
+        return self.keys
 
-            return True, id_nearest_car+1
-                
-        elif self.direction == TO_BOTTOM:
-            # Check to see if cars on this lane blocks entrance
-            id_nearest_car = self.find_nearest_car_to_bottom(car, 0, len(self.cars)-1)
-            if ( (id_nearest_car >= 0) and (self.cars[id_nearest_car].rect.top - safe_distance < car.rect.bottom ) ) or\
-               ( (id_nearest_car+1 < len(self.cars)) and (car.rect.top < self.cars[id_nearest_car+1].rect.bottom + safe_distance)):
-                return False, None
+    '''
+    Return the index of the nearest car in front of the given car (or at the same position), or -1 if there is none
+    '''
+    def find_nearest_car(self, car):
+        return bisect.bisect_right(self.position_keys(), self.key_of(car)) - 1
 
-            # Check to see if cars on lanes that cross this lane blocks entrance
-            for blocking_lane in self.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.include_car(c) and not car.outside_safe_distance_from(c, safe_distance, self.direction):
-                        return False, None
+    '''
+    Return indices first and last such that the left (top for a vertical lane) of self.cars[first:last]
+                        is greater than low and less than high
+    '''
+    def find_cars_between(self, low, high):
+        keys = self.position_keys()
+        if self.sign < 0:
+            return bisect.bisect_right(keys, low), bisect.bisect_left(keys, high)
+        else:
+            return bisect.bisect_right(keys, -high), bisect.bisect_left(keys, -low)
 
-            # Check to see if cars on this lane's next lane blocks entrance                  
-            if self.rect.bottom - safe_distance <= car.rect.bottom + car.speed:
-                for next_lane in self.next:
-                    if next_lane.trafficLight == REDLIGHT and next_lane.rect.top - safe_distance < car.rect.bottom:
-                        return False, None
-                    if len(next_lane.cars) > 0 and next_lane.cars[-1].rect.top - safe_distance < car.rect.bottom:
-                        return False, None
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c) and c.rect.top - safe_distance < car.rect.bottom:
-                                return False, None
+    '''
+    Insert a car into self.cars[idx], where idx has been found by can_change_lane
+    '''
+    def insert_car(self, idx, car):
+        keys = self.position_keys()
+        self.cars.insert(idx, car)
+        keys.insert(idx, self.key_of(car))
+        self.version += 1
+        self.keys_version = self.version
 
-            return True, id_nearest_car+1
-        
-        elif self.direction == TO_TOP:
-            # Check to see if cars on this lane blocks entrance
-            id_nearest_car = self.find_nearest_car_to_top(car, 0, len(self.cars)-1)
-            if ( (id_nearest_car >= 0) and (car.rect.top < self.cars[id_nearest_car].rect.bottom + safe_distance) ) or\
-               ( (id_nearest_car+1 < len(self.cars)) and (self.cars[id_nearest_car+1].rect.top - safe_distance < car.rect.bottom)):
-                return False, None
+    '''
+    Return cars on blocking lanes that this lane includes (i.e., cars crossing this lane)
+        The list is kept until a car enters, leaves, or moves on any blocking lane,
+                        so that cars queued on this lane do not scan all cars on blocking lanes one by one
+    '''
+    def find_occupants(self):
+        if len(self.blocking_lanes) == 0:
+            return self.occupants
+        versions = [lane.version for lane in self.blocking_lanes]
+        if versions != self.occupants_versions or not USE_LANE_OCCUPANTS:
+            self.occupants = []
+            for lane in self.blocking_lanes:
+                # Only cars whose left (or top) is less than a car's length before this lane can overlap it
+                first, last = lane.find_cars_between(getattr(self.rect, lane.low) - CAR_LENGTH, getattr(self.rect, lane.high))
+                self.occupants.extend([c for c in lane.cars[first:last] if self.include_car(c)])
+            self.occupants_versions = versions
+        return self.occupants
 
-            # Check to see if cars on lanes that cross this lane blocks entrance
-            for blocking_lane in self.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.include_car(c) and not car.outside_safe_distance_from(c, safe_distance, self.direction):
-                        return False, None
-                    
-            # Check to see if cars on this lane's next lane blocks entrance                            
-            if car.rect.top - car.speed <= self.rect.top + safe_distance:
-                for next_lane in self.next:
-                    if next_lane.trafficLight == REDLIGHT and car.rect.top < next_lane.rect.bottom + safe_distance:
-                        return False, None
-                    if len(next_lane.cars) > 0 and car.rect.top < next_lane.cars[-1].rect.bottom + safe_distance:
-                        return False, None
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c) and car.rect.top < c.rect.bottom + safe_distance:
-                                return False, None
+    '''
+    Return lanes whose cars or traffic lights can decide whether a car on this lane moves or changes lanes, i.e.,
+                        lanes that cross this lane or the lanes before and after this lane (see find_occupants),
+                        and lanes that any of them continue on and lanes that cross those,
+                        which matter only to cars near the end of lanes (see near_end)
+        Cars on the lanes before and after this lane (the last list returned)
+                        matter only if they are the nearest to a car (see find_neighbors)
+    '''
+    def find_dependencies(self):
+        if self.dependencies == None:
+            lanes, end_lanes = [], []
+            sides = [lane for lane in [self.before, self.after] if lane != None]
+            for lane in [self] + sides:
+                lanes.extend(lane.blocking_lanes)
+                for next_lane in lane.next:
+                    end_lanes.append(next_lane)
+                    end_lanes.extend(next_lane.blocking_lanes)
+            self.dependencies = list(dict.fromkeys(lanes)), list(dict.fromkeys(end_lanes)), sides
+        return self.dependencies
 
-            return True, id_nearest_car+1        
-        
-    def find_nearest_car_to_left(self, car, id_left, id_right):         # Perform binary search to find the nearest car
-        if (id_left > id_right):
-            return id_right   # If a car with the same position is not found, return the car to the nearest front
-        
-        id_mid = int((id_left+id_right)/2)
-        if (self.cars[id_mid].rect.left == car.rect.left):
-            return id_mid
-        elif (self.cars[id_mid].rect.left < car.rect.left):
-            return self.find_nearest_car_to_left(car, id_mid+1, id_right)
-        else:
-            return self.find_nearest_car_to_left(car, id_left, id_mid-1)
+    '''
+    Return the positions of the nearest cars in front of and behind a car that is not on this lane
+    '''
+    def find_neighbors(self, car):
+        idx = self.find_nearest_car(car)
+        front = (self.cars[idx].rect.x, self.cars[idx].rect.y) if idx >= 0 else None
+        back = (self.cars[idx+1].rect.x, self.cars[idx+1].rect.y) if idx+1 < len(self.cars) else None
+        return front, back
 
-    def find_nearest_car_to_right(self, car, id_left, id_right):         # Perform binary search to find the nearest car
-        if (id_left > id_right):
-            return id_right   # If a car with the same position is not found, return the car to the nearest front
-        
-        id_mid = int((id_left+id_right)/2)
-        if (self.cars[id_mid].rect.left == car.rect.left):
-            return id_mid
-        elif (self.cars[id_mid].rect.left < car.rect.left):
-            return self.find_nearest_car_to_right(car, id_left, id_mid-1)            
-        else:
-            return self.find_nearest_car_to_right(car, id_mid+1, id_right)
+    '''
+    Return True if a car on this lane is close enough to the end of this lane, or that of the lane before or after,
+                        for its move to depend on next lanes (see find_farthest_to_go and can_change_lane)
+    '''
+    def near_end(self, car):
+        car_front = self.sign * getattr(car.rect, self.front)
+        for lane in [self, self.before, self.after]:
+            if lane != None and lane.end - car_front <= car.speed + CAR_SAFE_DISTANCE * 2:
+                return True
+        return False
 
-    def find_nearest_car_to_bottom(self, car, id_top, id_bottom):         # Perform binary search to find the nearest car
-        if (id_top > id_bottom):
-            return id_bottom   # If a car with the same position is not found, return the car to the nearest front
-        
-        id_mid = int((id_top+id_bottom)/2)
-        if (self.cars[id_mid].rect.top == car.rect.top):
-            return id_mid
-        elif (self.cars[id_mid].rect.top < car.rect.top):
-            return self.find_nearest_car_to_bottom(car, id_top, id_mid-1)            
-        else:
-            return self.find_nearest_car_to_bottom(car, id_mid+1, id_bottom)
+    def passes_end(self, car):   # True if the car's front is beyond the end of this lane
+        return self.end < self.sign * getattr(car.rect, self.front)
 
-    def find_nearest_car_to_top(self, car, id_top, id_bottom):         # Perform binary search to find the nearest car
-        if (id_top > id_bottom):
-            return id_bottom   # If a car with the same position is not found, return the car to the nearest front
-        
-        id_mid = int((id_top+id_bottom)/2)
-        if (self.cars[id_mid].rect.top == car.rect.top):
-            return id_mid
-        elif (self.cars[id_mid].rect.top < car.rect.top):
-            return self.find_nearest_car_to_left(car, id_mid+1, id_bottom)
-        else:
-            return self.find_nearest_car_to_left(car, id_top, id_mid-1)
-        
     def include_pos(self, x, y):
         if (self.rect.left <= x) and (x <= self.rect.right) and\
                (self.rect.top <= y) and (y <= self.rect.bottom):
@@ -461,359 +632,226 @@ def configure_lanes_before_after(lanes):
 
 
 '''
-Define a Car object by extending pygame.sprite.Sprite
-The surface drawn on the screen is an attribute of a Car object
+Return a color that varies randomly around the given color by up to CAR_COLOR_VAR
+    Cars with the same color share the same tuple and the same sprites
+'''
+def new_car_color(base):
+    color = (CAR_COLOR_STEP * ((base[0]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR)) // CAR_COLOR_STEP),
+             CAR_COLOR_STEP * ((base[1]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR)) // CAR_COLOR_STEP),
+             CAR_COLOR_STEP * ((base[2]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR)) // CAR_COLOR_STEP))
+    return car_colors.setdefault(color, color)
+
+'''
+Define a Car object
+Cars have no surfaces of their own: painting blits a sprite shared by cars of the same color and size,
+                        so spawning, recoloring, and removing cars allocate no pixels
 '''
 class Car():
+    __slots__ = ('car_id', 'road', 'lane', 'rect', 'color', 'prev_color', 'speed', 'accident',
+                 'sleepable', 'sleep_key', 'sleep_reason', 'num_lane_candidates')
+
     def __init__(self, pygame, road, lane, x, y):
+        self.car_id = next(car_ids)
         self.road = road
         self.lane = lane       
         
         if self.lane.direction == TO_LEFT or self.lane.direction == TO_RIGHT:
-            self.surf = pygame.Surface((CAR_LENGTH, CAR_WIDTH))  # X/Y size
+            self.rect = new_rect(pygame, CAR_LENGTH, CAR_WIDTH, (x,y))  # X/Y size
         elif self.lane.direction == TO_BOTTOM or self.lane.direction == TO_TOP:
-            self.surf = pygame.Surface((CAR_WIDTH, CAR_LENGTH))  # X/Y size
+            self.rect = new_rect(pygame, CAR_WIDTH, CAR_LENGTH, (x,y))  # X/Y size
 
-        self.color = (CAR_COLOR[0]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR),
-                        CAR_COLOR[1]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR),
-                        CAR_COLOR[2]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR))     
-        self.surf.fill(self.color)
-        self.rect = self.surf.get_rect(center=(x,y))
+        self.color = new_car_color(CAR_COLOR)
+        self.prev_color = None          # Color before an accident
         self.speed = random.randint(CAR_SPEED-CAR_SPEED_VAR, CAR_SPEED+CAR_SPEED_VAR)                
         self.accident = False                
+        self.sleepable = False          # Stopped at the last move without trying to change lanes
+        self.sleep_key = None           # State of what decided the last stop, if this car sleeps (see move)
+        self.sleep_reason = None
+        self.num_lane_candidates = None # Number of lanes found by change_lane_v2 at the last move
 
-    def outside_safe_distance_from(self, car, safe_distance, direction):
-        if direction == TO_LEFT or direction == TO_RIGHT:
-            if car.rect.right + safe_distance <= self.rect.left or\
-               self.rect.right < car.rect.left - safe_distance:
-                return True
-            else:
-                return False
-        elif direction == TO_BOTTOM or direction == TO_TOP:
-            if car.rect.bottom + safe_distance <= self.rect.top or\
-               self.rect.bottom < car.rect.top - safe_distance:
-                return True
-            else:
-                return False
+    '''
+    Return True if this car and the given car are apart by safe_distance along an axis,
+                        whose sides are low and high (i.e., left and right, or top and bottom)
+    '''
+    def outside_safe_distance_from(self, car, safe_distance, low, high):
+        if getattr(car.rect, high) + safe_distance <= getattr(self.rect, low) or\
+           getattr(self.rect, high) < getattr(car.rect, low) - safe_distance:
+            return True
+        else:
+            return False
         
     def paint_on(self, screen):        
-        screen.blit(self.surf, self.rect)
+        key = (self.color, self.rect.size)
+        sprite = car_sprites.get(key)
+        if sprite == None:
+            sprite = self.lane.pygame.Surface(self.rect.size)
+            sprite.fill(self.color)
+            car_sprites[key] = sprite
+        screen.blit(sprite, self.rect)
 
     '''
     Find the farthest distance that this can can go at the current round,
                         considering other cars and traffic lights
+    Return the limit as progress along the lane (see Lane)
     '''
     def find_farthest_to_go(self):
-        if self.lane.direction == TO_LEFT:            
-            limit = self.lane.x_preceding_car + CAR_SAFE_DISTANCE            
-            reason = BLOCKED
-
-            # Consider cars on lanes the cross this lane
-            for blocking_lane in self.lane.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.lane.include_car(c) and c.rect.right < self.rect.left:
-                        limit = max(limit, c.rect.right + CAR_SAFE_DISTANCE)                        
-
-            # Consider cars and traffic lights on lanes the this lane continues on
-            if self.rect.left - self.speed <= self.lane.rect.left + CAR_SAFE_DISTANCE:
-                for next_lane in self.lane.next:
-                    if next_lane.trafficLight == REDLIGHT:
-                        limit = max(limit, next_lane.rect.right + CAR_SAFE_DISTANCE)                        
-                        if limit == next_lane.rect.right + CAR_SAFE_DISTANCE:
-                            reason = REDLIGHT                        
-                        break   # At a red light, no need to check other conditions that provide looser limits
-                    
-                    if len(next_lane.cars) > 0:
-                        limit = max(limit, next_lane.cars[-1].rect.right + CAR_SAFE_DISTANCE)                        
-                        
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c):
-                                limit = max(limit, c.rect.right + CAR_SAFE_DISTANCE)                                
-                                
-        elif self.lane.direction == TO_RIGHT:
-            limit = self.lane.x_preceding_car - CAR_SAFE_DISTANCE            
-            reason = BLOCKED
-
-            # Consider cars on lanes the cross this lane
-            for blocking_lane in self.lane.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.lane.include_car(c) and self.rect.right < c.rect.left:
-                        limit = min(limit, c.rect.left - CAR_SAFE_DISTANCE)                        
-
-            # Consider cars and traffic lights on lanes the this lane continues on            
-            if self.lane.rect.right - CAR_SAFE_DISTANCE <= self.rect.right + self.speed:
-                for next_lane in self.lane.next:
-                    if next_lane.trafficLight == REDLIGHT:
-                        limit = min(limit, next_lane.rect.left - CAR_SAFE_DISTANCE)                        
-                        if limit == next_lane.rect.left - CAR_SAFE_DISTANCE:
-                            reason = REDLIGHT                        
-                        break   # At a red light, no need to check other conditions that provide looser limits
-                    
-                    if len(next_lane.cars) > 0:
-                        limit = min(limit, next_lane.cars[-1].rect.left - CAR_SAFE_DISTANCE)                        
-                        
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c):
-                                limit = min(limit, c.rect.left - CAR_SAFE_DISTANCE)
-                                
-        elif self.lane.direction == TO_BOTTOM:
-            limit = self.lane.y_preceding_car - CAR_SAFE_DISTANCE            
-            reason = BLOCKED
-
-            # Consider cars on lanes the cross this lane
-            for blocking_lane in self.lane.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.lane.include_car(c) and self.rect.bottom < c.rect.top:
-                        limit = min(limit, c.rect.top - CAR_SAFE_DISTANCE)                        
-
-            # Consider cars and traffic lights on lanes the this lane continues on            
-            if self.lane.rect.bottom - CAR_SAFE_DISTANCE <= self.rect.bottom + self.speed:
-                for next_lane in self.lane.next:
-                    if next_lane.trafficLight == REDLIGHT:
-                        limit = min(limit, next_lane.rect.top - CAR_SAFE_DISTANCE)                        
-                        if limit == next_lane.rect.top - CAR_SAFE_DISTANCE:
-                            reason = REDLIGHT                        
-                        break   # At a red light, no need to check other conditions that provide looser limits
-                    
-                    if len(next_lane.cars) > 0:
-                        limit = min(limit, next_lane.cars[-1].rect.top - CAR_SAFE_DISTANCE)                        
-                        
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c):
-                                limit = min(limit, c.rect.top - CAR_SAFE_DISTANCE)                                
-
-        elif self.lane.direction == TO_TOP:            
-            limit = self.lane.y_preceding_car + CAR_SAFE_DISTANCE            
-            reason = BLOCKED
-
-            # Consider cars on lanes the cross this lane
-            for blocking_lane in self.lane.blocking_lanes:
-                for c in blocking_lane.cars:
-                    if self.lane.include_car(c) and c.rect.bottom < self.rect.top:
-                        limit = max(limit, c.rect.bottom + CAR_SAFE_DISTANCE)
-
-            # Consider cars and traffic lights on lanes the this lane continues on                                    
-            if self.rect.top - self.speed <= self.lane.rect.top + CAR_SAFE_DISTANCE:
-                for next_lane in self.lane.next:
-                    if next_lane.trafficLight == REDLIGHT:
-                        limit = max(limit, next_lane.rect.bottom + CAR_SAFE_DISTANCE)                        
-                        if limit == next_lane.rect.bottom + CAR_SAFE_DISTANCE:
-                            reason = REDLIGHT                        
-                        break   # At a red light, no need to check other conditions that provide looser limits
-                    
-                    if len(next_lane.cars) > 0:
-                        limit = max(limit, next_lane.cars[-1].rect.bottom + CAR_SAFE_DISTANCE)                        
-                        
-                    for blocking_lane in next_lane.blocking_lanes:
-                        for c in blocking_lane.cars:
-                            if next_lane.include_car(c):
-                                limit = max(limit, c.rect.bottom + CAR_SAFE_DISTANCE)                                
-                                
+        lane = self.lane
+        sign, rear = lane.sign, lane.rear
+        limit = lane.preceding_car - CAR_SAFE_DISTANCE
+        reason = BLOCKED
+
+        # Consider cars on lanes the cross this lane
+        car_front = sign * getattr(self.rect, lane.front)
+        for c in lane.find_occupants():
+            c_rear = sign * getattr(c.rect, rear)
+            if car_front < c_rear:
+                limit = min(limit, c_rear - CAR_SAFE_DISTANCE)
+
+        # Consider cars and traffic lights on lanes the this lane continues on
+        if lane.end - CAR_SAFE_DISTANCE <= car_front + self.speed:
+            for next_lane in lane.next:
+                if next_lane.trafficLight == REDLIGHT:
+                    limit = min(limit, next_lane.begin - CAR_SAFE_DISTANCE)
+                    if limit == next_lane.begin - CAR_SAFE_DISTANCE:
+                        reason = REDLIGHT
+                    break   # At a red light, no need to check other conditions that provide looser limits
+
+                if len(next_lane.cars) > 0:
+                    limit = min(limit, sign * getattr(next_lane.cars[-1].rect, rear) - CAR_SAFE_DISTANCE)
+
+                for c in next_lane.find_occupants():
+                    limit = min(limit, sign * getattr(c.rect, rear) - CAR_SAFE_DISTANCE)
+
         return limit, reason
 
     '''
     Move this car.
+        A car that has stopped without lanes to change into sleeps until anything that decided the stop changes,
+                        i.e., the position of the preceding car, nearest cars on the lanes before and after its lane,
+                        or cars and traffic lights on lanes in lane.find_dependencies()
+        A sleeping car replays its last move, so it keeps sending STOP reports and changing colors as an awake car does
     Return True if this car remains on the current lane. Return False otherwise.
     '''    
-    def move(self, batch):   
-        if self.lane.direction == TO_LEFT:
-            if self.accident:
-                self.lane.x_preceding_car = self.rect.right                
-                self.lane.status_preceding_car = BLOCKED                
-                return True
+    def move(self, batch):
+        if not USE_SLEEPING_CARS or self.accident:
+            self.sleepable = False
+            self.sleep_key = None
+            return self.move_awake(batch)
 
-            limit, reason = self.find_farthest_to_go()
-
-            prev_lane = self.lane
-            prev_left = self.rect.left
-            if limit <= self.rect.left - self.speed:    # GO
-                self.rect.left = self.rect.left - self.speed    # Move at the assigned speed
-                self.lane.x_preceding_car = self.rect.right                
-                self.lane.status_preceding_car = GO
-            else:   # REDLIGHT or BLOCKED
-                '''
-                At a red light, cars from different lanes may not stop along the same line,
-                        because they have come at diffrent speeds, and thus
-                        they can see the red light at different positions
-                '''
-                if (limit < self.rect.left):    # Do not move beyond the limit
-                    self.rect.left = limit
-                    
-                if reason == REDLIGHT:  # REDLIGHT                    
-                    self.lane.x_preceding_car = self.rect.right                
-                    self.lane.status_preceding_car = REDLIGHT
-                    
-                else: # BLOCKED
-                    if self.change_lane_v2(CAR_CHANGE_LANE_RATE_BLOCKED):
-                        pass
-                    else:
-                        self.lane.x_preceding_car = self.rect.right
-                        if self.lane.status_preceding_car == REDLIGHT:
-                            pass # Blocked because preceding cars stop at a red light
-                        else:
-                            # Blocked because of accidents or congestion
-                            self.lane.status_preceding_car == BLOCKED
-                            if self.rect.left == prev_left: # Could not move at all, thus send a report
-                                batch.report(self, report.EVENT_STOP)                                
-                                self.change_color()                
-            
-            if self.rect.left < self.lane.rect.left: # Add to the next lane
-                self.add_to_next_lane()                
+        if self.sleep_key != None and self.still_asleep():
+            self.move_asleep(batch)
+            return True
+        self.sleep_key = None
+        key = self.find_sleep_key() if self.sleepable else None
+
+        lane, x, y = self.lane, self.rect.x, self.rect.y
+        self.num_lane_candidates = None
+        remains = self.move_awake(batch)
+        # If change_lane_v2 was not called, the car stopped at a red light
+        self.sleepable = remains and self.lane == lane and self.rect.x == x and self.rect.y == y and\
+                         (self.num_lane_candidates == None or self.num_lane_candidates == 0)
+        if self.sleepable and key != None:
+            self.sleep_key = key
+            self.sleep_reason = REDLIGHT if self.num_lane_candidates == None else BLOCKED
+        return remains
 
-            if self.lane != prev_lane or self.rect.left < self.lane.rect.left:
-                return False    # Lane changed
-            else:            
-                return True     # Lane remains the same            
-            
-        elif self.lane.direction == TO_RIGHT:            
-            if self.accident:
-                self.lane.x_preceding_car = self.rect.left                
-                self.lane.status_preceding_car = BLOCKED                
-                return True
+    '''
+    Return what decides the move of this car: the position of the preceding car and this car,
+                        the versions (and traffic lights) of lanes to watch while sleeping,
+                        and the versions of the lanes before and after this lane with the nearest cars on them
+    '''
+    def find_sleep_key(self):
+        preceding = self.lane.preceding_car
+        lanes, end_lanes, sides = self.lane.find_dependencies()
+        if self.lane.near_end(self):
+            lanes = lanes + end_lanes
+        return (preceding, self.rect.x, self.rect.y, lanes, [(lane.version, lane.trafficLight) for lane in lanes],
+                [lane.version for lane in sides], [lane.find_neighbors(self) for lane in sides])
 
-            limit, reason = self.find_farthest_to_go()
-
-            prev_lane = self.lane
-            prev_right = self.rect.right
-            if self.rect.right + self.speed <= limit:    # GO
-                self.rect.right = self.rect.right + self.speed    # Move at the assigned speed
-                self.lane.x_preceding_car = self.rect.left                
-                self.lane.status_preceding_car = GO
-            else:   # REDLIGHT or BLOCKED
-                '''
-                At a red light, cars from different lanes may not stop along the same line,
-                        because they have come at diffrent speeds, and thus
-                        they can see the red light at different positions
-                '''
-                if (self.rect.right < limit):    # Do not move beyond the limit
-                    self.rect.right = limit
-                    
-                if reason == REDLIGHT:  # REDLIGHT                    
-                    self.lane.x_preceding_car = self.rect.left                
-                    self.lane.status_preceding_car = REDLIGHT
-                    
-                else: # BLOCKED
-                    if self.change_lane_v2(CAR_CHANGE_LANE_RATE_BLOCKED):
-                        pass
-                    else:
-                        self.lane.x_preceding_car = self.rect.left
-                        if self.lane.status_preceding_car == REDLIGHT:
-                            pass # Blocked because preceding cars stop at a red light
-                        else:
-                            # Blocked because of accidents or congestion
-                            self.lane.status_preceding_car == BLOCKED
-                            if self.rect.right == prev_right: # Could not move at all, thus send a report
-                                batch.report(self, report.EVENT_STOP)                                
-                                self.change_color()                
-            
-            if self.lane.rect.right < self.rect.right: # Add to the next lane
-                self.add_to_next_lane()                
-
-            if self.lane != prev_lane or self.lane.rect.right < self.rect.right:
-                return False    # Lane changed
-            else:            
-                return True     # Lane remains the same                       
-
-        elif self.lane.direction == TO_BOTTOM:            
-            if self.accident:
-                self.lane.y_preceding_car = self.rect.top                
-                self.lane.status_preceding_car = BLOCKED                
-                return True
+    '''
+    Return True if nothing in the sleep key of this car has changed
+        If cars have moved on the lanes before and after this lane, but not the nearest ones, the car keeps sleeping
+    '''
+    def still_asleep(self):
+        preceding, x, y, lanes, states, side_versions, neighbors = self.sleep_key
+        if self.lane.preceding_car != preceding or self.rect.x != x or self.rect.y != y or\
+           [(lane.version, lane.trafficLight) for lane in lanes] != states:
+            return False
 
-            limit, reason = self.find_farthest_to_go()
-
-            prev_lane = self.lane
-            prev_bottom = self.rect.bottom
-            if self.rect.bottom + self.speed <= limit:    # GO
-                self.rect.bottom = self.rect.bottom + self.speed    # Move at the assigned speed
-                self.lane.y_preceding_car = self.rect.top                
-                self.lane.status_preceding_car = GO
-            else:   # REDLIGHT or BLOCKED
-                '''
-                At a red light, cars from different lanes may not stop along the same line,
-                        because they have come at diffrent speeds, and thus
-                        they can see the red light at different positions
-                '''
-                if (self.rect.bottom < limit):    # Do not move beyond the limit
-                    self.rect.bottom = limit
-                    
-                if reason == REDLIGHT:  # REDLIGHT                    
-                    self.lane.y_preceding_car = self.rect.top
-                    self.lane.status_preceding_car = REDLIGHT
-                    
-                else: # BLOCKED
-                    if self.change_lane_v2(CAR_CHANGE_LANE_RATE_BLOCKED):
-                        pass
-                    else:
-                        self.lane.y_preceding_car = self.rect.top
-                        if self.lane.status_preceding_car == REDLIGHT:
-                            pass # Blocked because preceding cars stop at a red light
-                        else:
-                            # Blocked because of accidents or congestion
-                            self.lane.status_preceding_car == BLOCKED
-                            if self.rect.bottom == prev_bottom: # Could not move at all, thus send a report
-                                batch.report(self, report.EVENT_STOP)                                
-                                self.change_color()                
-            
-            if self.lane.rect.bottom < self.rect.bottom: # Add to the next lane
-                self.add_to_next_lane()                
-
-            if self.lane != prev_lane or self.lane.rect.bottom < self.rect.bottom:
-                return False    # Lane changed
-            else:            
-                return True     # Lane remains the same                        
-
-        elif self.lane.direction == TO_TOP:            
-            if self.accident:
-                self.lane.y_preceding_car = self.rect.bottom
-                self.lane.status_preceding_car = BLOCKED                
-                return True
+        sides = self.lane.find_dependencies()[2]
+        versions = [lane.version for lane in sides]
+        if versions != side_versions:
+            if [lane.find_neighbors(self) for lane in sides] != neighbors:
+                return False
+            self.sleep_key = (preceding, x, y, lanes, states, versions, neighbors)
+        return True
 
-            limit, reason = self.find_farthest_to_go()
-
-            prev_lane = self.lane
-            prev_top = self.rect.top
-            if limit <= self.rect.top - self.speed:    # GO
-                self.rect.top = self.rect.top - self.speed    # Move at the assigned speed
-                self.lane.y_preceding_car = self.rect.bottom
-                self.lane.status_preceding_car = GO
-            else:   # REDLIGHT or BLOCKED
-                '''
-                At a red light, cars from different lanes may not stop along the same line,
-                        because they have come at diffrent speeds, and thus
-                        they can see the red light at different positions
-                '''
-                if (limit < self.rect.top):    # Do not move beyond the limit
-                    self.rect.top = limit
-                    
-                if reason == REDLIGHT:  # REDLIGHT                    
-                    self.lane.y_preceding_car = self.rect.bottom
-                    self.lane.status_preceding_car = REDLIGHT
-                    
-                else: # BLOCKED
-                    if self.change_lane_v2(CAR_CHANGE_LANE_RATE_BLOCKED):
-                        pass
-                    else:
-                        self.lane.y_preceding_car = self.rect.bottom
-                        if self.lane.status_preceding_car == REDLIGHT:
-                            pass # Blocked because preceding cars stop at a red light
-                        else:
-                            # Blocked because of accidents or congestion
-                            self.lane.status_preceding_car == BLOCKED
-                            if self.rect.top == prev_top: # Could not move at all, thus send a report
-                                batch.report(self, report.EVENT_STOP)                                
-                                self.change_color()                
-            
-            if self.rect.top < self.lane.rect.top: # Add to the next lane
-                self.add_to_next_lane()                
+    '''
+    Repeat the last move of this car, which stopped without moving
+    '''
+    def move_asleep(self, batch):
+        self.lane.preceding_car = self.lane.sign * getattr(self.rect, self.lane.rear)
+
+        if self.sleep_reason == REDLIGHT:
+            self.lane.status_preceding_car = REDLIGHT
+        elif self.lane.status_preceding_car != REDLIGHT:    # Blocked because of accidents or congestion
+            batch.report(self, report.EVENT_STOP)
+            self.change_color()
+
+    def move_awake(self, batch):
+        lane = self.lane
+        sign, front, rear = lane.sign, lane.front, lane.rear
+        if self.accident:
+            lane.preceding_car = sign * getattr(self.rect, rear)
+            lane.status_preceding_car = BLOCKED
+            return True
 
-            if self.lane != prev_lane or self.rect.top < self.lane.rect.top:
-                return False    # Lane changed
-            else:            
-                return True     # Lane remains the same            
+        limit, reason = self.find_farthest_to_go()
+
+        prev_front = car_front = sign * getattr(self.rect, front)
+        if car_front + self.speed <= limit:    # GO
+            car_front = car_front + self.speed  # Move at the assigned speed
+            setattr(self.rect, front, sign * car_front)
+            lane.version += 1
+            lane.preceding_car = sign * getattr(self.rect, rear)
+            lane.status_preceding_car = GO
+        else:   # REDLIGHT or BLOCKED
+            '''
+            At a red light, cars from different lanes may not stop along the same line,
+                    because they have come at diffrent speeds, and thus
+                    they can see the red light at different positions
+            '''
+            if (car_front < limit):    # Do not move beyond the limit
+                setattr(self.rect, front, sign * limit)
+                car_front = sign * getattr(self.rect, front)
+                lane.version += 1
+
+            if reason == REDLIGHT:  # REDLIGHT
+                lane.preceding_car = sign * getattr(self.rect, rear)
+                lane.status_preceding_car = REDLIGHT
+
+            else: # BLOCKED
+                if self.change_lane_v2(CAR_CHANGE_LANE_RATE_BLOCKED):
+                    pass
+                else:
+                    lane.preceding_car = sign * getattr(self.rect, rear)
+                    if lane.status_preceding_car == REDLIGHT:
+                        pass # Blocked because preceding cars stop at a red light
+                    else:
+                        # Blocked because of accidents or congestion
+                        lane.status_preceding_car == BLOCKED
+                        if car_front == prev_front: # Could not move at all, thus send a report
+                            batch.report(self, report.EVENT_STOP)
+                            self.change_color()
+
+        # Changing lanes keeps the progress of this car, as lanes before and after run in the same direction
+        if self.lane.end < car_front: # Add to the next lane
+            self.add_to_next_lane()
+
+        if self.lane != lane or self.lane.end < car_front:
+            return False    # Lane changed
+        else:
+            return True     # Lane remains the same
 
     '''
     Move this car to the lane that the current lane continues on
@@ -829,6 +867,7 @@ class Car():
             self.road = lane.road
             self.lane = lane            
             lane.cars.append(self)
+            lane.version += 1
         else:
             pass    # Move outside the screen
 
@@ -848,37 +887,32 @@ class Car():
                 lanes.append((self.lane.after, idx))
 
         # Change lanes probabilistically
+        self.num_lane_candidates = len(lanes)
         if len(lanes)>0 and random.randrange(1,100) <= (probability * 100):     
             if (len(lanes) == 1):
                 lane, idx = lanes[0]
             else:
                 lane, idx = lanes[random.randrange(0,len(lanes)-1)]
-            lane.cars.insert(idx, self)            
+            if not lane.passes_end(self):   # Otherwise, move() takes the car to a next lane of the new lane
+                lane.insert_car(idx, self)
             self.lane = lane
             return True
             
         return False
   
     def change_color(self):
-            self.color = (CAR_COLOR[0]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR),
-                        CAR_COLOR[1]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR),
-                        CAR_COLOR[2]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR))
-            self.surf.fill(self.color)
+            self.color = new_car_color(CAR_COLOR)
             
     def toggle_accident(self, batch):
         if not self.accident:
             self.accident = True
             self.prev_color = self.color
-            self.color = (CAR_COLOR_ACCIDENT[0]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR),
-                        CAR_COLOR_ACCIDENT[1]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR),
-                        CAR_COLOR_ACCIDENT[2]+random.randrange(-CAR_COLOR_VAR,CAR_COLOR_VAR))
-            self.surf.fill(self.color)
+            self.color = new_car_color(CAR_COLOR_ACCIDENT)
             batch.report(self, report.EVENT_ACCIDENT)
             
         else:
             self.accident = False
             self.color = self.prev_color
-            self.surf.fill(self.color)
 
     def distance_from(self, x, y):
         return math.sqrt((self.rect.centerx - x)**2 + (self.rect.centery-y)**2)
@@ -940,6 +974,9 @@ class Intersection():
         
         # Added for consistency with Road objects
         self.lanes_for_new_cars = []        
+        self.road_id = None
+        self.compatible_roads = None
+        self.compatible_road_ids = None
         self.name_str = '-'.join([road.name_str for road in self.roads])
         
     def add_newCar(self):            
@@ -1109,6 +1146,7 @@ def add_intersections(roads):
                     lane.trafficLight = REDLIGHT
                     
     roads.extend(intersections)
+    assign_road_ids(roads)
     '''
     for road in roads:
         print(road.name_str)
@@ -1117,6 +1155,20 @@ def add_intersections(roads):
     '''
     return intersections
 
+'''
+Give each road and intersection a small integer id, and
+                    precompute on_the_same_road_with for every pair of them,
+                    so that report.on_the_same_road needs a single lookup
+'''
+def assign_road_ids(roads):
+    for road_id, road in enumerate(roads):
+        road.road_id = road_id
+    compatibility = [[r1.on_the_same_road_with(r2) for r2 in roads] for r1 in roads]
+    for road in roads:
+        road.compatible_roads = compatibility[road.road_id]
+        road.compatible_road_ids = [road_id for road_id, compatible in enumerate(road.compatible_roads) if compatible]
+    return compatibility
+
 def add_blocking_lanes(to_lanes, blocking_lanes):
     for lane in to_lanes:
         lane.blocking_lanes.extend(blocking_lanes)